@@ -0,0 +1,45 @@
+# post_finnhub_from_profile2 imports
+import importlib
+
+
+# Public API, by module. The module of a name is only imported when the name is used, so importing the
+# package or using the manifest does not import pandas, SQLAlchemy or the data base driver
+PUBLIC_API = {
+    "manifest": ["list_profile2_files", "get_profile2_file_name", "load_manifest", "get_files_to_ingest",
+                 "save_manifest"],
+    "metrics": ["add_metrics_sink", "remove_metrics_sink", "measure_stage", "get_round_trips", "PrintSink",
+                "ListSink", "JsonLinesSink", "PrometheusTextfileSink"],
+    "formats": ["PROFILE2_FORMATS", "get_file_format", "read_profile2_table", "convert_profile2_files"],
+    "fetcher": ["FETCH_SETTINGS", "fetch_profile2_files", "read_tickers"],
+    "connections": ["get_engine", "get_session_factory", "dispose_engines", "data_base_connection",
+                    "save_table", "compact_frame", "get_memory_report"],
+    "functions": ["read_csv_files", "read_data_base", "keep_new_names", "check_status_new_name",
+                  "keep_new_contacts", "check_status_new_contact", "set_company_id", "format_data", "save_data"],
+    "streaming": ["STREAMING_SETTINGS", "read_profile2_streaming"],
+    "snapshot": ["refresh_snapshot", "verify_snapshot"],
+    "pipeline": ["PIPELINE_STAGES", "run_stage", "run_pipeline"],
+    "migrations": ["create_company_id_sequence", "ensure_company_id_sequence", "create_indexes",
+                   "delete_duplicates"],
+    "synthetic_data": ["generate_data_set"],
+}
+dict_name_modules = {name: module for module, lst_names in PUBLIC_API.items() for name in lst_names}
+__all__ = list(dict_name_modules)
+
+
+def __getattr__(name):
+    """ Get a name of the public API, importing its module the first time.
+    Args:
+        name (str): name of a function, class or setting of PUBLIC_API
+    Returns:
+        The object of the module
+    """
+
+    if name not in dict_name_modules:
+        raise AttributeError("module {} has no attribute {}".format(__name__, name))
+    value = getattr(importlib.import_module("." + dict_name_modules[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
@@ -0,0 +1,353 @@
+# benchmarks imports
+import argparse
+import sys
+import io
+import subprocess
+import tempfile
+import time
+from contextlib import redirect_stdout
+from datetime import datetime
+from os.path import abspath, basename, dirname, isfile, join
+import numpy as np
+import pandas as pd
+
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import text
+
+from .connections import dispose_engines, get_engine, get_session_factory, is_shared_between_threads
+from .functions import (check_status_new_contact, check_status_new_name, format_data, keep_new_contacts,
+                        keep_new_names, read_csv_files, read_data_base, resolve_company_ids, save_data, set_company_id)
+from .fuzzy_match import FUZZY_SETTINGS, get_candidate_pairs, get_fuzzy_company_ids, get_normalized_keys
+from .metrics import ListSink, add_metrics_sink, get_overlap, remove_metrics_sink
+from .model_requests import (Company, CompanyContact, CompanyDescription, CompanyIpo, get_query_company_contact,
+                             get_query_company_description, get_query_company_ipo, get_query_merged_base)
+from .pipeline import run_stage_in_thread
+from .synthetic_data import generate_data_base, generate_data_set, generate_profile2, generate_universe
+
+__all__ = ["BENCHMARK_COLUMNS", "BENCHMARK_SIZES", "IMPORT_COMMANDS", "run_benchmark", "run_fuzzy_benchmark",
+           "run_import_benchmark", "get_scaling_exponent", "get_query_plan", "check_index_usage", "save_results",
+           "get_scaling_curves", "plot_scaling_curves"]
+
+BENCHMARK_COLUMNS = ["run_id", "date", "db", "nb_companies", "stage", "wall_seconds", "cpu_seconds", 
+                     "rows_in", "rows_out", "peak_rss_bytes", "db_round_trips"]
+BENCHMARK_SIZES = [1000, 10000, 100000, 1000000]
+# Commands timed by run_import_benchmark, run in the folder of the package. "{mypath}" is an empty files folder,
+# "{package}" the package name. "load stages" imports pandas, SQLAlchemy and the models, like every command
+# did before the lazy imports
+IMPORT_COMMANDS = {"load stages": ["-c", "import pandas, {package}.model_requests"],
+                   "import functions": ["-c", "import {package}.functions"],
+                   "pipeline --help": ["-m", "{package}.pipeline", "--help"],
+                   "fetcher --help": ["-m", "{package}.fetcher", "--help"],
+                   "formats --help": ["-m", "{package}.formats", "--help"],
+                   "manifest check": ["-m", "{package}.manifest", "{mypath}"],
+                   "package manifest check": ["-c", "import {package}; "
+                                                    "{package}.get_files_to_ingest('{mypath}', {{}})"]}
+
+
+def run_benchmark(nb_companies, db_url, workdir, seed=0, nb_processes=None, nb_threads=None):
+    """ Generate a data set and run the pipeline on it, like the notebook runs it.
+    Each stage is measured, see measure_stage. The tables of the database are replaced.
+    With nb_threads, the database is read while the csv files are parsed, see run_pipeline.
+    Args:
+        nb_companies (int): Number of companies of the universe
+        db_url (str): Throwaway database, like "sqlite:///benchmark.db" or "postgresql://..."
+        workdir (str): Location of the profile2 files folder
+        seed (int): Seed of the random generator, the same seed gives the same data
+        nb_processes (int): Number of processes resolving the companies, see resolve_company_ids
+        nb_threads (int): Number of threads downloading and saving the tables, see read_data_base and save_data
+    Returns:
+        pd.DataFrame: For each stage, the record of measure_stage
+    """
+
+    engine = get_engine(db_url)
+    with redirect_stdout(io.StringIO()):
+        generate_data_set(nb_companies, workdir, engine, seed=seed)
+    session = get_session_factory(engine)()
+
+    sink = add_metrics_sink(ListSink())
+    try:
+        with redirect_stdout(io.StringIO()):
+            if (nb_threads is not None) and is_shared_between_threads(engine):
+                with ThreadPoolExecutor(max_workers=1) as executor:
+                    future_base = executor.submit(run_stage_in_thread, "read_data_base", {}, {}, engine, 
+                                                  nb_threads=nb_threads)
+                    df_company_profile2 = read_csv_files(workdir)
+                    df_merged_base = future_base.result()["df_merged_base"]
+            else:
+                df_company_profile2 = read_csv_files(workdir)
+                df_merged_base = read_data_base(session, nb_threads=nb_threads)
+            session.commit()
+
+            df_company_new_name = keep_new_names(df_company_profile2, df_merged_base)
+            df_comp_to_add, df_comp_names_changed = check_status_new_name(df_company_new_name, df_merged_base,
+                                                                          nb_processes=nb_processes)
+            df_company_new_contact = keep_new_contacts(df_company_profile2, df_merged_base)
+            df_comp_contact_to_add, df_comp_contact_changed = \
+                check_status_new_contact(df_company_new_contact, df_merged_base, nb_processes=nb_processes)
+            df_comp_to_add = set_company_id(df_comp_to_add, df_merged_base, session=session)
+            session.commit()
+            df_company, df_comp_description, df_comp_contact, df_comp_ipo = \
+                format_data(df_comp_to_add, df_comp_names_changed, df_comp_contact_changed)
+            save_data(df_company, df_comp_description, df_comp_contact, df_comp_ipo, engine, nb_threads=nb_threads)
+    finally:
+        remove_metrics_sink(sink)
+        session.close()
+
+    df_results = pd.DataFrame(sink.records)
+    df_results["db"] = engine.dialect.name
+    df_results["nb_companies"] = nb_companies
+    return df_results
+
+
+def run_fuzzy_benchmark(lst_sizes, seed=0, fuzzy_settings=None):
+    """ Time the fuzzy matching of the renames (see get_fuzzy_company_ids) on universes of 
+    lst_sizes companies, where half of the renamed companies have their phone and weburl 
+    reformatted. The number of pairs compared by row shows the blocking keeps it sub-quadratic.
+    Args:
+        lst_sizes (list): Numbers of companies of the universes
+        seed (int): Seed of the random generator, the same seed gives the same data
+        fuzzy_settings (dict): Settings replacing the ones of FUZZY_SETTINGS
+    Returns:
+        pd.DataFrame: For each size, the rows resolved, the pairs compared, the matches and the time
+    """
+
+    settings = dict(FUZZY_SETTINGS, **(fuzzy_settings or {}))
+    lst_results = []
+    for nb_companies in lst_sizes:
+        df_universe = generate_universe(nb_companies, seed=seed)
+        df_merged_base = generate_data_base(df_universe, seed=seed)[0].merge(df_universe, on="id_company")\
+            .rename(columns={"ipo": "date_ipo"})
+        df_company_new = generate_profile2(df_universe, seed=seed, ratio_reformatted=0.5)
+
+        # The rows without exact match go to the fuzzy matching
+        ids_company = resolve_company_ids(df_company_new, df_merged_base)
+        df_new = df_company_new.loc[ids_company.isna().values]
+
+        start = time.perf_counter()
+        ids_found = get_fuzzy_company_ids(df_new, df_merged_base, settings)
+        end = time.perf_counter()
+
+        df_keys_new = get_normalized_keys(df_new, "ipo")
+        df_pairs = get_candidate_pairs(df_keys_new, get_normalized_keys(df_merged_base, "date_ipo"), 
+                                       settings["max_block_size"], settings["max_candidates"], settings["ngram"])
+        lst_results.append({"nb_companies": nb_companies, "rows": len(df_new), "pairs": len(df_pairs),
+                            "pairs_by_row": len(df_pairs) / max(len(df_new), 1), "all_pairs": 
+                            len(df_new) * len(df_merged_base), "found": len(ids_found), "seconds": end - start})
+    return pd.DataFrame(lst_results)
+
+
+def run_import_benchmark(repeat=5, dict_commands=IMPORT_COMMANDS, reference="load stages"):
+    """ Time the start of the commands which need neither the tables nor the data base, each in a new
+    Python process, with the modules imported by each one.
+    Args:
+        repeat (int): Number of runs of each command, the median is kept
+        dict_commands (dict): For each command name, the arguments of python, see IMPORT_COMMANDS
+        reference (str): Command the others are compared to
+    Returns:
+        pd.DataFrame: For each command, the median seconds, the ratio to the reference, and if
+        pandas and SQLAlchemy were imported
+    """
+
+    folder_path = dirname(abspath(__file__))
+    package = basename(folder_path)
+    lst_records = []
+    with tempfile.TemporaryDirectory() as tmp_path:
+        for command, lst_args in dict_commands.items():
+            lst_args = [arg.format(mypath=tmp_path, package=package) for arg in lst_args]
+            lst_seconds = []
+            for i in range(repeat):
+                start = time.perf_counter()
+                process = subprocess.run([sys.executable, "-X", "importtime"] + lst_args, cwd=dirname(folder_path),
+                                         stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+                lst_seconds.append(time.perf_counter() - start)
+                if process.returncode != 0:
+                    print('An exception flew by!')
+                    print("The command {} failed: {}".format(command, process.stderr[-1000:]))
+                    sys.exit(1)
+            # -X importtime writes one line by module imported, ending with its name
+            lst_modules = [line.split("|")[-1].strip() for line in process.stderr.splitlines()]
+            lst_records.append({"command": command, "seconds": np.median(lst_seconds),
+                                "pandas": "pandas" in lst_modules, "sqlalchemy": "sqlalchemy" in lst_modules})
+
+    df_imports = pd.DataFrame(lst_records)
+    df_imports["ratio"] = df_imports["seconds"] / df_imports.loc[df_imports["command"] == reference,
+                                                                   "seconds"].iloc[0]
+    return df_imports[["command", "seconds", "ratio", "pandas", "sqlalchemy"]]
+
+
+def get_scaling_exponent(sr_size, sr_value):
+    """ Fit value = a * size ** k in log-log scale. k is 1 for a linear growth, 2 for a quadratic one.
+    Args:
+        sr_size (pd.Series): sizes
+        sr_value (pd.Series): values measured, like the time
+    Returns:
+        float: exponent k
+    """
+
+    return np.polyfit(np.log(sr_size.astype(float)), np.log(sr_value.astype(float)), 1)[0]
+
+
+def get_query_plan(session, query):
+    """ Get the plan of a query from the database: EXPLAIN on PostgreSQL, EXPLAIN QUERY PLAN on SQLite.
+    Args:
+        session (sqlalchemy.session): data base session, use to make request
+        query (sqlalchemy.orm.query.Query): query to explain
+    Returns:
+        str: plan, one line by step
+    """
+
+    dialect = session.bind.dialect
+    sql = str(query.statement.compile(dialect=dialect, compile_kwargs={"literal_binds": True}))
+    explain = "EXPLAIN QUERY PLAN " if dialect.name == "sqlite" else "EXPLAIN "
+    lst_rows = session.execute(text(explain + sql)).fetchall()
+    # SQLite gives the step in the last column, PostgreSQL in the only one
+    return "\n".join(str(row[-1]) for row in lst_rows)
+
+
+def check_index_usage(session, verbose=True):
+    """ Check with the plans of the database that the join and lookup queries use the indexes 
+    declared on the models (see create_indexes). The values looked up are the ones of a company 
+    of the database, it should not be empty.
+    Args:
+        session (sqlalchemy.session): data base session, use to make request
+        verbose (bool): Print the checks if True
+    Returns:
+        pd.DataFrame: For each query, the index expected, if the plan uses it and the plan
+    """
+
+    id_company, date_ipo, phone, weburl, name = get_query_merged_base(session)\
+        .with_entities(Company.id_company, CompanyIpo.date_ipo, CompanyContact.phone, CompanyContact.weburl,
+                       CompanyDescription.name)\
+        .filter(CompanyContact.phone.isnot(None)).first()
+
+    lst_checks = [("join of a company", get_query_merged_base(session).filter(Company.id_company == id_company),
+                   ["ix_companyipo_id_company", "ix_companycontact_id_company", "ix_companydescription_id_company"]),
+                  ("lookup by date Ipo", get_query_company_ipo(session).filter(CompanyIpo.date_ipo == date_ipo),
+                   ["ix_companyipo_date_ipo"]),
+                  ("lookup by phone", get_query_company_contact(session).filter(CompanyContact.phone == phone),
+                   ["ix_companycontact_phone"]),
+                  ("lookup by weburl", get_query_company_contact(session).filter(CompanyContact.weburl == weburl),
+                   ["ix_companycontact_weburl"]),
+                  ("lookup by name", get_query_company_description(session)\
+                   .filter(CompanyDescription.name == name), ["ix_companydescription_name"])]
+
+    lst_report = []
+    for query_name, query, lst_indexes in lst_checks:
+        plan = get_query_plan(session, query)
+        for index_name in lst_indexes:
+            lst_report.append({"query": query_name, "index": index_name, "is_used": index_name in plan, 
+                               "plan": plan})
+    session.commit()
+
+    df_report = pd.DataFrame(lst_report)
+    if verbose:
+        print(df_report[["query", "index", "is_used"]].to_string(index=False))
+    return df_report
+
+
+def save_results(df_results, output_path):
+    """ Append the results of a run to the results file, to track them over time.
+    Args:
+        df_results (pd.DataFrame): Results of the run, see run_benchmark
+        output_path (str): Location of the csv file, created if needed
+    """
+
+    df_results[BENCHMARK_COLUMNS].to_csv(output_path, mode="a", index=False, header=not isfile(output_path))
+
+
+def get_scaling_curves(df_results):
+    """ Pivot the results: one row by stage, one column by number of companies, the wall time.
+    Args:
+        df_results (pd.DataFrame): Results, see run_benchmark
+    Returns:
+        pd.DataFrame: time in seconds of each stage for each number of companies
+    """
+
+    df_curves = df_results.pivot_table(index="stage", columns="nb_companies", values="wall_seconds", aggfunc="mean")
+    return df_curves.reindex(df_results["stage"].unique())
+
+
+def plot_scaling_curves(df_curves, plot_path):
+    """ Draw the scaling curves, time against number of companies in log-log scale.
+    Args:
+        df_curves (pd.DataFrame): Curves, see get_scaling_curves
+        plot_path (str): Location of the image
+    """
+
+    # matplotlib is only needed for the plot
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    ax = df_curves.T.plot(logx=True, logy=True, marker="o", figsize=(10, 6))
+    ax.set_xlabel("companies")
+    ax.set_ylabel("seconds")
+    plt.savefig(plot_path, bbox_inches="tight")
+    plt.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time each stage of the pipeline on synthetic data.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=BENCHMARK_SIZES[:2],
+                        help="Numbers of companies, like 1000 10000 100000 1000000")
+    parser.add_argument("--db-url", default=None,
+                        help="Throwaway database, its tables are replaced. A temporary SQLite file by default")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the random generator")
+    parser.add_argument("--processes", type=int, default=None,
+                        help="Number of processes resolving the companies by shards of dates Ipo")
+    parser.add_argument("--threads", type=int, default=None,
+                        help="Number of threads downloading and saving the tables, while the csv files are parsed")
+    parser.add_argument("--output", default="benchmark_results.csv", help="Results file, the runs are appended")
+    parser.add_argument("--plot", default=None, help="Image of the scaling curves, needs matplotlib")
+    parser.add_argument("--fuzzy", action="store_true", help="Time only the fuzzy matching of the renames")
+    parser.add_argument("--explain", action="store_true", 
+                        help="Check the join and lookup queries use the indexes, on the last size")
+    parser.add_argument("--imports", action="store_true",
+                        help="Time only the start of the commands which need neither the tables nor the data base")
+    args = parser.parse_args()
+
+    if args.imports:
+        df_imports = run_import_benchmark()
+        print(df_imports.to_string(index=False, float_format="{:.3f}".format))
+        sys.exit(0)
+
+    if args.fuzzy:
+        df_fuzzy = run_fuzzy_benchmark(args.sizes, seed=args.seed)
+        print(df_fuzzy.to_string(index=False, float_format="{:.3f}".format))
+        if len(df_fuzzy) > 1:
+            print("Scaling exponent of the pairs: {:.2f}, of the time: {:.2f}"\
+.format(get_scaling_exponent(df_fuzzy["nb_companies"], df_fuzzy["pairs"]),
+        get_scaling_exponent(df_fuzzy["nb_companies"], df_fuzzy["seconds"])))
+        sys.exit(0)
+
+    run_id = datetime.now().strftime("%Y%m%d_%H%M%S")
+    lst_results = []
+    with tempfile.TemporaryDirectory() as tmp_path:
+        db_url = args.db_url or "sqlite:///{}".format(join(tmp_path, "benchmark.db"))
+        for nb_companies in args.sizes:
+            df_results = run_benchmark(nb_companies, db_url, join(tmp_path, str(nb_companies)), seed=args.seed,
+                                       nb_processes=args.processes, nb_threads=args.threads)
+            df_results["run_id"] = run_id
+            df_results["date"] = datetime.now().isoformat(timespec="seconds")
+            save_results(df_results, args.output)
+            lst_results.append(df_results)
+            is_stage = df_results["stage"].isin(["read_csv_files", "read_data_base", "keep_new_names", 
+                                                 "check_status_new_name", "keep_new_contacts", 
+                                                 "check_status_new_contact", "set_company_id", "format_data", 
+                                                 "save_data"])
+            print("{} companies: {:.2f} secondes".format(nb_companies, 
+                                                         df_results.loc[is_stage, "wall_seconds"].sum()))
+            # Above 1, some stages ran at the same time
+            is_io = df_results["stage"].isin(["read_csv_files", "read_data_base"])
+            print("Overlap of the reads: {:.2f}".format(get_overlap(df_results.loc[is_io].to_dict("records"))\
+["overlap_ratio"]))
+        if args.explain:
+            session = get_session_factory(get_engine(db_url))()
+            check_index_usage(session)
+            session.close()
+        dispose_engines()
+
+    df_curves = get_scaling_curves(pd.concat(lst_results, ignore_index=True))
+    print(df_curves.to_string(float_format="{:.3f}".format))
+    if args.plot is not None:
+        plot_scaling_curves(df_curves, args.plot)
@@ -0,0 +1,346 @@
+# fetcher imports
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from os import replace
+from os.path import isfile, join
+
+# pandas is imported by the functions writing and reading tables, so the fetcher starts without it
+from .manifest import get_profile2_columns, get_profile2_file_name
+from .metrics import JsonLinesSink, add_metrics_sink, measure_stage
+
+__all__ = ["FINNHUB_PROFILE2_URL", "FETCH_CHECKPOINT_FILE_NAME", "FETCH_SETTINGS", "TokenBucket", "get_retry_after",
+           "request_profile2", "fetch_ticker", "load_fetch_checkpoint", "write_profile2_chunk",
+           "fetch_profile2_files_async", "fetch_profile2_files", "read_tickers"]
+
+
+FINNHUB_PROFILE2_URL = "https://finnhub.io/api/v1/stock/profile2"
+FETCH_CHECKPOINT_FILE_NAME = "profile2_fetch_checkpoint.jsonl"
+# Default settings of the fetcher: the requests by second allowed by the API (1 is 60 by minute,
+# the free plan), the requests sent in a burst, the retries of a ticker and their first and longest
+# wait in seconds, the timeout of a request, the companies by file and the requests running at once
+FETCH_SETTINGS = {"rate": 1.0, "burst": 1, "max_retries": 5, "backoff": 2.0, "backoff_max": 60.0,
+                  "timeout": 10.0, "file_size": 500, "max_concurrency": 8}
+
+
+class TokenBucket:
+    """ Limit the requests to rate by second. The bucket holds at most capacity tokens, refilled
+    at rate tokens by second, each request takes one token and waits for it if the bucket is empty.
+    So the requests start exactly at the rate of the API, whatever the number of workers.
+    Args:
+        rate (float): tokens by second
+        capacity (int): most tokens kept, the requests which can start at once
+        clock (function): time in seconds, time.monotonic by default
+    """
+
+    def __init__(self, rate, capacity=1, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.tokens = capacity
+        self.last = clock()
+        # Created in the event loop, by the first acquire
+        self.lock = None
+
+    def refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    async def acquire(self):
+        """ Wait for a token and take it """
+
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            self.refill()
+            while self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                self.refill()
+            self.tokens -= 1
+
+    def slow_down(self, seconds):
+        """ Give no token for the next seconds, after the API answered "too many requests" """
+
+        self.refill()
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+
+def get_retry_after(headers):
+    """ Read the seconds to wait asked by the server.
+    Args:
+        headers (email.message.Message): headers of the answer
+    Returns:
+        float: seconds of the header Retry-After, None if the header is missing or is a date
+    """
+
+    try:
+        return float(headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+
+def request_profile2(ticker, token, base_url=FINNHUB_PROFILE2_URL, timeout=10.0):
+    """ Request the profile2 of a company to finnhub.
+    Args:
+        ticker (str): ticker of the company
+        token (str): finnhub API key
+        base_url (str): url of the profile2 endpoint
+        timeout (float): seconds before the request is given up
+    Returns:
+        int: HTTP status, None if the server did not answer
+        dict: profile2 of the company, empty if finnhub does not know the ticker. None if the status is not 200
+        float: seconds to wait asked by the server, see get_retry_after
+    """
+
+    url = "{}?{}".format(base_url, urllib.parse.urlencode({"symbol": ticker}))
+    request = urllib.request.Request(url, headers={"X-Finnhub-Token": token})
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return response.status, json.loads(response.read().decode("utf-8")), None
+    except urllib.error.HTTPError as error:
+        return error.code, None, get_retry_after(error.headers)
+    except (OSError, ValueError):
+        # Timeout, connection refused or reset, answer cut
+        return None, None, None
+
+
+async def fetch_ticker(ticker, bucket, executor, token, base_url, settings):
+    """ Fetch the profile2 of a company, when the bucket gives a token. The request runs in a thread
+    of executor. The errors of the server and of the network are retried, waiting twice longer each
+    time. When the API answers "too many requests" (429), the bucket gives no token for that time.
+    The other client errors (like 404 or 422) are not retried, the ticker gets an empty profile,
+    like a ticker unknown by finnhub.
+    Args:
+        ticker (str): ticker of the company
+        bucket (TokenBucket): rate limit of the API
+        executor (concurrent.futures.ThreadPoolExecutor): threads running the requests
+        token (str): finnhub API key
+        base_url (str): url of the profile2 endpoint
+        settings (dict): settings of the fetcher, see FETCH_SETTINGS
+    Returns:
+        int: HTTP status of the last answer, None if the server did not answer
+        dict: profile2 of the company, None if it failed after the retries
+    """
+
+    loop = asyncio.get_running_loop()
+    for attempt in range(settings["max_retries"] + 1):
+        await bucket.acquire()
+        status, profile, retry_after = await loop.run_in_executor(executor, request_profile2, ticker, token,
+                                                                  base_url, settings["timeout"])
+        if status == 200:
+            return status, profile
+        if status in [401, 403]:
+            print('An exception flew by!')
+            print("The finnhub API refused the key (status {}) - check your token".format(status))
+            sys.exit(1)
+        if (status is not None) and (status != 429) and (status < 500):
+            return status, {}
+
+        wait = min(settings["backoff"] * 2 ** attempt, settings["backoff_max"])
+        if retry_after is not None:
+            wait = max(wait, retry_after)
+        if status == 429:
+            # All the workers wait, the next token comes after the wait
+            bucket.slow_down(wait)
+        else:
+            await asyncio.sleep(wait)
+    return status, None
+
+
+def load_fetch_checkpoint(mypath):
+    """ Load the profiles already fetched, one json line by ticker.
+    Args:
+        mypath (str): Location of the files folder
+    Returns:
+        dict: For each ticker fetched, its profile2
+    """
+
+    dict_profiles = {}
+    checkpoint_path = join(mypath, FETCH_CHECKPOINT_FILE_NAME)
+    if not isfile(checkpoint_path):
+        return dict_profiles
+    with open(checkpoint_path) as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # Last line cut by a crash, the ticker is fetched again
+                continue
+            dict_profiles[record["ticker"]] = record["profile"]
+    return dict_profiles
+
+
+def write_profile2_chunk(mypath, start, end, lst_profiles):
+    """ Write the profiles of the companies start to end in a file read by read_csv_files.
+    The companies unknown by finnhub, or refused by the API, give an empty line. The file is written in a temporary
+    file first, so a crash never leaves a truncated file.
+    Args:
+        mypath (str): Location of the files folder
+        start (int): Position of the first company in the list of tickers
+        end (int): Position of the last company, included
+        lst_profiles (list): profile2 of each company, in the list order
+    Returns:
+        str: file name written
+    """
+
+    import pandas as pd
+    file = get_profile2_file_name(start, end)
+    df_profile2 = pd.DataFrame.from_records(lst_profiles).reindex(columns=get_profile2_columns())
+    df_profile2.to_csv(join(mypath, file + ".tmp"), index=False)
+    replace(join(mypath, file + ".tmp"), join(mypath, file))
+    return file
+
+
+async def fetch_profile2_files_async(lst_tickers, mypath, token, base_url=FINNHUB_PROFILE2_URL, settings=None,
+                                     verbose=True):
+    """ Fetch the profile2 of the companies and write them in files of file_size companies,
+    "company_profile2_0_499.csv"... in the order of lst_tickers. A file is written once all its
+    companies are fetched. Each ticker fetched is saved at once in the checkpoint of the folder,
+    so a run stopped goes on from there: keep the same list of tickers.
+    Args:
+        lst_tickers (list): tickers of the companies
+        mypath (str): Location of the files folder, created if needed
+        token (str): finnhub API key
+        base_url (str): url of the profile2 endpoint
+        settings (dict): Settings replacing the ones of FETCH_SETTINGS
+        verbose (bool): Print the files written and the tickers failed if True
+    Returns:
+        list: file names written by the run
+    """
+
+    settings = dict(FETCH_SETTINGS, **(settings or {}))
+    os.makedirs(mypath, exist_ok=True)
+    dict_profiles = load_fetch_checkpoint(mypath)
+
+    # Tickers missing by file, and files of each ticker
+    file_size = settings["file_size"]
+    lst_chunks = [(start, min(start + file_size, len(lst_tickers)) - 1) 
+                  for start in range(0, len(lst_tickers), file_size)]
+    lst_missing = [0] * len(lst_chunks)
+    dict_ticker_chunks = {}
+    for position, ticker in enumerate(lst_tickers):
+        dict_ticker_chunks.setdefault(ticker, []).append(position // file_size)
+        if ticker not in dict_profiles:
+            lst_missing[position // file_size] += 1
+
+    lst_files = []
+
+    def write_chunk(chunk):
+        start, end = lst_chunks[chunk]
+        lst_profiles = [dict_profiles[ticker] for ticker in lst_tickers[start:end + 1]]
+        file = write_profile2_chunk(mypath, start, end, lst_profiles)
+        lst_files.append(file)
+        if verbose:
+            print("File written: {}".format(file))
+
+    with measure_stage("fetch_profile2", rows_in=len(lst_tickers)) as record:
+        # Files of a run stopped after the last fetch
+        for chunk, (start, end) in enumerate(lst_chunks):
+            if (lst_missing[chunk] == 0) and not isfile(join(mypath, get_profile2_file_name(start, end))):
+                write_chunk(chunk)
+
+        queue = deque(ticker for ticker in dict_ticker_chunks if ticker not in dict_profiles)
+        lst_failed = []
+        lst_refused = []
+        bucket = TokenBucket(settings["rate"], settings["burst"])
+
+        with ThreadPoolExecutor(max_workers=settings["max_concurrency"]) as executor, \
+                open(join(mypath, FETCH_CHECKPOINT_FILE_NAME), "a") as checkpoint_file:
+
+            async def worker():
+                while queue:
+                    ticker = queue.popleft()
+                    status, profile = await fetch_ticker(ticker, bucket, executor, token, base_url, settings)
+                    if profile is None:
+                        lst_failed.append(ticker)
+                        continue
+                    if status != 200:
+                        # Refused for good, checkpointed empty so its file is written
+                        lst_refused.append("{} ({})".format(ticker, status))
+                    dict_profiles[ticker] = profile
+                    checkpoint_file.write(json.dumps({"ticker": ticker, "profile": profile, "status": status}) + "\n")
+                    checkpoint_file.flush()
+                    for chunk in dict_ticker_chunks[ticker]:
+                        lst_missing[chunk] -= 1
+                        if lst_missing[chunk] == 0:
+                            write_chunk(chunk)
+
+            await asyncio.gather(*[worker() for _ in range(settings["max_concurrency"])])
+        record["rows_out"] = len(dict_ticker_chunks) - len(lst_failed)
+
+    if verbose and lst_refused:
+        print("Tickers refused by the API, written empty: {}".format(", ".join(lst_refused)))
+    if verbose and lst_failed:
+        print("Tickers failed, fetched at the next run: {}".format(", ".join(lst_failed)))
+    return lst_files
+
+
+def fetch_profile2_files(lst_tickers, mypath, token, base_url=FINNHUB_PROFILE2_URL, settings=None, verbose=True):
+    """ Fetch the profile2 of the companies and write the files, see fetch_profile2_files_async.
+    Args:
+        lst_tickers (list): tickers of the companies
+        mypath (str): Location of the files folder, created if needed
+        token (str): finnhub API key
+        base_url (str): url of the profile2 endpoint
+        settings (dict): Settings replacing the ones of FETCH_SETTINGS
+        verbose (bool): Print the files written and the tickers failed if True
+    Returns:
+        list: file names written by the run
+    """
+
+    return asyncio.run(fetch_profile2_files_async(lst_tickers, mypath, token, base_url=base_url,
+                                                  settings=settings, verbose=verbose))
+
+
+def read_tickers(file_path):
+    """ Read the tickers to fetch from a csv, like the one of the finnhub stock symbol endpoint.
+    Args:
+        file_path (str): Location of the csv, with a column "symbol" or "ticker", or the tickers in the first column
+    Returns:
+        list: tickers, in the file order
+    """
+
+    import pandas as pd
+    df_tickers = pd.read_csv(file_path, dtype=object)
+    column = next((column for column in ["symbol", "ticker"] if column in df_tickers.columns), df_tickers.columns[0])
+    return list(df_tickers[column].dropna())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fetch the finnhub profile2 of companies into csv files.")
+    parser.add_argument("tickers_file", help="csv with the tickers, in a column symbol or ticker")
+    parser.add_argument("mypath", help="Location of the files folder")
+    parser.add_argument("--token", default=os.environ.get("FINNHUB_TOKEN"),
+                        help="finnhub API key, the variable FINNHUB_TOKEN by default")
+    parser.add_argument("--url", default=FINNHUB_PROFILE2_URL, help="url of the profile2 endpoint")
+    parser.add_argument("--rate", type=float, default=FETCH_SETTINGS["rate"],
+                        help="Requests by second allowed by the API, 1 for 60 by minute")
+    parser.add_argument("--burst", type=int, default=FETCH_SETTINGS["burst"], help="Requests sent in a burst")
+    parser.add_argument("--concurrency", type=int, default=FETCH_SETTINGS["max_concurrency"],
+                        help="Requests running at once")
+    parser.add_argument("--file-size", type=int, default=FETCH_SETTINGS["file_size"], help="Companies by file")
+    parser.add_argument("--max-retries", type=int, default=FETCH_SETTINGS["max_retries"], help="Retries of a ticker")
+    parser.add_argument("--metrics-json", default=None, help="File where to append the stage metrics as json lines")
+    args = parser.parse_args()
+
+    if not args.token:
+        print('An exception flew by!')
+        print("No finnhub API key - give --token or set FINNHUB_TOKEN")
+        sys.exit(1)
+    if args.metrics_json is not None:
+        add_metrics_sink(JsonLinesSink(args.metrics_json))
+
+    settings = {"rate": args.rate, "burst": args.burst, "max_concurrency": args.concurrency,
+                "file_size": args.file_size, "max_retries": args.max_retries}
+    lst_files = fetch_profile2_files(read_tickers(args.tickers_file), args.mypath, args.token, base_url=args.url,
+                                     settings=settings)
+    print("Files written: {}".format(len(lst_files)))
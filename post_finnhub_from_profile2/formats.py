@@ -0,0 +1,249 @@
+# formats imports
+import argparse
+import gzip
+import os
+import sys
+from contextlib import contextmanager
+from os import replace
+from os.path import isfile, join
+
+# pandas and pyarrow are imported by the functions reading and writing the files, so the converter
+# starts without them
+from .manifest import get_profile2_columns, list_profile2_files
+
+__all__ = ["PROFILE2_FORMATS", "PROFILE2_READ_COLUMNS", "get_file_format", "open_text_file", "get_text_frame",
+           "get_file_columns", "iter_profile2_table", "read_profile2_table", "write_profile2_table",
+           "convert_profile2_files"]
+
+
+# Format of the profile2 files by extension. The zstd files are read and written with pyarrow,
+# pandas reads the gzip ones
+PROFILE2_FORMATS = {".csv": "csv", ".csv.gz": "csv", ".csv.zst": "csv", ".jsonl": "jsonl", ".jsonl.gz": "jsonl",
+                    ".jsonl.zst": "jsonl", ".parquet": "parquet", ".feather": "feather"}
+# Columns of the profile2 files used by the program
+PROFILE2_READ_COLUMNS = ["ticker", "name", "logo", "weburl", "phone", "ipo", "date_description"]
+
+
+def get_file_format(file):
+    """ Get the format of a profile2 file from its extension.
+    Args:
+        file (str): file name or location
+    Returns:
+        str: "csv", "jsonl", "parquet" or "feather"
+        str: extension, like ".csv.gz"
+    """
+
+    for extension in sorted(PROFILE2_FORMATS, key=len, reverse=True):
+        if file.endswith(extension):
+            return PROFILE2_FORMATS[extension], extension
+    print('An exception flew by!')
+    print("The format of the file {} is unknown - use one of {}".format(file, ", ".join(PROFILE2_FORMATS)))
+    sys.exit(1)
+
+
+@contextmanager
+def open_text_file(file_path):
+    """ Open a csv or jsonl file, decompressed with pyarrow if it ends with ".zst".
+    Args:
+        file_path (str): Location of the file
+    Yields:
+        The location for pandas if it can read it, else a binary file object
+    """
+
+    if not file_path.endswith(".zst"):
+        yield file_path
+        return
+
+    # pyarrow is only needed for the zstd files
+    import pyarrow as pa
+    with pa.input_stream(file_path, compression="zstd") as stream:
+        yield stream
+
+
+def get_text_frame(df, lst_text_columns=()):
+    """ Convert the columns to text like read_csv with dtype=object: the values to str,
+    the empty ones to NaN. The columns of lst_text_columns already hold str values, they are 
+    not converted, only their empty values if they have some.
+    Args:
+        df (pd.DataFrame): Table read from a typed format
+        lst_text_columns (iterable): columns of str values, like the string columns of a parquet file
+    Returns:
+        pd.DataFrame: Table with object columns
+    """
+
+    df = df.copy(deep=False)
+    for column in df.columns:
+        sr = df[column]
+        if column not in lst_text_columns:
+            df[column] = sr.astype(str).where(sr.notna()).astype(object)
+        elif sr.isna().any():
+            df[column] = sr.where(sr.notna())
+    return df
+
+
+def get_file_columns(file_path):
+    """ Get the columns of a profile2 file, without reading its rows. A jsonl record can leave out
+    the keys of its empty values, so the columns of a jsonl file are the keys of its first line 
+    and the profile2 columns of finnhub (see get_profile2_columns), which iter_profile2_table 
+    reads on every line.
+    Args:
+        file_path (str): Location of the file
+    Returns:
+        list: column names
+    """
+
+    file_format, extension = get_file_format(file_path)
+    if file_format == "parquet":
+        import pyarrow.parquet as pq
+        return pq.read_schema(file_path).names
+    if file_format == "feather":
+        import pyarrow as pa
+        with pa.memory_map(file_path) as source:
+            return pa.ipc.open_file(source).schema.names
+    import pandas as pd
+    with open_text_file(file_path) as source:
+        if file_format == "csv":
+            return list(pd.read_csv(source, nrows=0).columns)
+        header = list(pd.read_json(source, lines=True, nrows=1, dtype=False).columns)
+    return header + [column for column in get_profile2_columns() if column not in header]
+
+
+def iter_profile2_table(file_path, usecols, chunksize=None, engine="c"):
+    """ Read the columns usecols of a profile2 file, by chunks of chunksize rows or at once.
+    Parquet and feather files are memory-mapped, only the columns used are read. It is not a 
+    zero-copy read: the text columns become Python str objects, like the ones of read_csv, the 
+    other ones are also converted to text.
+    Args:
+        file_path (str): Location of the file
+        usecols (list): columns to read, they must be in the file. A jsonl line without some 
+            of them gets empty values
+        chunksize (int): rows by chunk, the whole file in one chunk if None
+        engine (str): pandas parser engine of the csv files, "c", "python" or "pyarrow". 
+            The pyarrow engine does not read by chunks, the c engine reads the chunks instead
+    Yields:
+        pd.DataFrame: chunk with the columns usecols, text values like read_csv with dtype=object
+    """
+
+    file_format, extension = get_file_format(file_path)
+    if file_format in ["parquet", "feather"]:
+        if file_format == "parquet":
+            import pyarrow.parquet as pq
+            table = pq.read_table(file_path, columns=usecols, memory_map=True)
+        else:
+            import pyarrow.feather as feather
+            table = feather.read_table(file_path, columns=usecols, memory_map=True)
+        import pyarrow as pa
+        lst_text_columns = [field.name for field in table.schema
+                            if pa.types.is_string(field.type) or pa.types.is_large_string(field.type)]
+        batches = table.to_batches(max_chunksize=chunksize) if chunksize is not None else [table]
+        for batch in batches:
+            yield get_text_frame(batch.to_pandas(), lst_text_columns)[usecols]
+        return
+
+    import pandas as pd
+    with open_text_file(file_path) as source:
+        if file_format == "csv":
+            if chunksize is None:
+                yield pd.read_csv(source, dtype=object, usecols=usecols, engine=engine)
+            else:
+                yield from pd.read_csv(source, dtype=object, usecols=usecols, chunksize=chunksize,
+                                       engine="c" if engine == "pyarrow" else engine)
+        else:
+            reader = pd.read_json(source, lines=True, dtype=False, chunksize=chunksize)
+            for df_chunk in ([reader] if chunksize is None else reader):
+                yield get_text_frame(df_chunk.reindex(columns=usecols))
+
+
+def read_profile2_table(file_path, usecols, engine="c"):
+    """ Read the columns usecols of a profile2 file, see iter_profile2_table.
+    Args:
+        file_path (str): Location of the file
+        usecols (list): columns to read, they must be in the file
+        engine (str): pandas parser engine of the csv files, "c", "python" or "pyarrow"
+    Returns:
+        pd.DataFrame: Table with the columns usecols
+    """
+
+    return next(iter_profile2_table(file_path, usecols, engine=engine))
+
+
+def write_profile2_table(df, file_path):
+    """ Write a profile2 table in the format of its extension, through a temporary file so
+    a crash never leaves a truncated file.
+    Args:
+        df (pd.DataFrame): Table with the profile2 columns, text values
+        file_path (str): Location of the file
+    """
+
+    file_format, extension = get_file_format(file_path)
+    tmp_path = file_path + ".tmp"
+    if file_format == "parquet":
+        df.to_parquet(tmp_path, index=False)
+    elif file_format == "feather":
+        df.reset_index(drop=True).to_feather(tmp_path)
+    else:
+        if file_format == "csv":
+            text = df.to_csv(index=False)
+        else:
+            text = df.to_json(orient="records", lines=True).rstrip("\n") + "\n"
+        if extension.endswith(".zst"):
+            import pyarrow as pa
+            destination = pa.output_stream(tmp_path, compression="zstd")
+        elif extension.endswith(".gz"):
+            destination = gzip.open(tmp_path, "wb")
+        else:
+            destination = open(tmp_path, "wb")
+        with destination:
+            destination.write(text.encode("utf-8"))
+    replace(tmp_path, file_path)
+
+
+def convert_profile2_files(mypath, output_path, extension=".parquet", lst_files=None, verbose=True):
+    """ Rewrite the profile2 files of a folder in another format, in output_path, with the same
+    names and the extension of the format. The files already converted are skipped. All the
+    columns are kept, as text.
+    Args:
+        mypath (str): Location of the files folder
+        output_path (str): Location of the converted files folder, created if needed. Not mypath,
+            the files of the same companies would be read twice
+        extension (str): extension of the format, see PROFILE2_FORMATS
+        lst_files (list): file names to convert, all the profile2 files of mypath if None
+        verbose (bool): Print the files written if True
+    Returns:
+        list: file names written
+    """
+
+    get_file_format(extension)
+    if os.path.abspath(mypath) == os.path.abspath(output_path):
+        print('An exception flew by!')
+        print("The converted files must be written in another folder than {}".format(mypath))
+        sys.exit(1)
+    os.makedirs(output_path, exist_ok=True)
+    if lst_files is None:
+        lst_files = list_profile2_files(mypath)
+
+    lst_written = []
+    for file in lst_files:
+        file_format, file_extension = get_file_format(file)
+        output_file = file[:-len(file_extension)] + extension
+        if isfile(join(output_path, output_file)):
+            continue
+        file_path = join(mypath, file)
+        df_profile2 = read_profile2_table(file_path, get_file_columns(file_path))
+        write_profile2_table(df_profile2, join(output_path, output_file))
+        lst_written.append(output_file)
+        if verbose:
+            print("File written: {}".format(output_file))
+    return lst_written
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert the profile2 files to another format.")
+    parser.add_argument("mypath", help="Location of the files folder")
+    parser.add_argument("output_path", help="Location of the converted files folder")
+    parser.add_argument("--format", dest="extension", choices=sorted(PROFILE2_FORMATS), default=".parquet",
+                        help="Extension of the format of the converted files")
+    args = parser.parse_args()
+
+    lst_written = convert_profile2_files(args.mypath, args.output_path, extension=args.extension)
+    print("Files written: {}".format(len(lst_written)))
@@ -1,39 +1,98 @@
-import pandas as pd
-
 from datetime import date
-import time
-import re
 
-import sys
-from os import listdir
-from os.path import isfile, join
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import repeat
+from os.path import join
+
+from .connections import compact_frame, copy_insert, get_pandas_from_query, is_shared_between_threads, save_table
+from .formats import PROFILE2_READ_COLUMNS, get_file_columns, read_profile2_table
+from .fuzzy_match import get_fuzzy_company_ids
+from .lazy_imports import LazyModule
+from .manifest import check_file_records, get_file_records, list_profile2_files
+from .metrics import measure_stage, measured
+from .snapshot import refresh_snapshot
+from .streaming import STREAMING_SETTINGS, read_profile2_streaming
+
+__all__ = ["read_profile2_file", "read_csv_files", "read_data_base", "read_tables", "compare_merged_base",
+           "stage_company_profile2", "is_data_base_empty", "iter_chunks", "drop_alias_rows", "keep_new_names",
+           "resolve_company_ids", "get_first_company_ids", "get_ipo_shards", "get_first_company_ids_sharded",
+           "keep_new_names_server_side", "check_status_new_name", "keep_new_contacts", "keep_new_contacts_server_side",
+           "check_status_new_contact", "set_company_id", "format_data", "save_data"]
+
+# pandas, SQLAlchemy and the models are imported by the first function using them, so importing the
+# module does not import them
+pd = LazyModule("pandas")
+db = LazyModule("sqlalchemy")
+model_requests = LazyModule(".model_requests", __package__)
+migrations = LazyModule(".migrations", __package__)
+
+
+def read_profile2_file(file_path, engine="c"):
+    """ Read one file got from finnhub, in any format of PROFILE2_FORMATS, parsing only the columns 
+    used by the program.
+    Args:
+        file_path (str) : Location of the file
+        engine (str) : pandas parser engine of the csv, "c", "python" or "pyarrow"
+    Returns:
+        pd.DataFrame: Table with the columns ticker, name, logo, weburl, phone, ipo 
+        and date_description if the file has it
+    """
 
-from connections import *
-from model_requests import *
+    header = get_file_columns(file_path)
+    usecols = [column for column in header if column in PROFILE2_READ_COLUMNS]
+    return read_profile2_table(file_path, usecols, engine=engine)
 
 
-def read_csv_files(mypath):
-    """ Read all the csv got from finnhub. 
+@measured("read_csv_files")
+def read_csv_files(mypath, max_workers=None, engine="c", lst_files=None, compact=False, streaming_settings=None,
+                   dict_file_records=None):
+    """ Read all the files got from finnhub. 
     The file names should be "company_profile2_0_499.csv", "company_profile2_500_999.csv"... 
+    They can also be compressed csv or jsonl, parquet or feather, see PROFILE2_FORMATS and formats.py
+    to convert them.
     The data are split in many files because each set of 500 companies takes 3 hours to request.
     It is only a precaution for crases, they have the same structure. 
+    The files are read concurrently, and only the columns used are parsed.
     Args:
         mypath (str) : Location of the files folder
+        max_workers (int) : Number of threads reading the files, None for the default pool size
+        engine (str) : pandas parser engine, "c", "python" or "pyarrow" (pandas >= 1.4)
+        lst_files (list) : file names to read, for example from get_files_to_ingest. All the files if None
+        compact (bool) : Return the table with compact types if True, see compact_frame
+        streaming_settings (dict) : If given, the files are read by chunks one after the other, keeping
+            only the rows kept and the hashes of the names in memory, see read_profile2_streaming. 
+            {} for the default settings STREAMING_SETTINGS
+        dict_file_records (dict) : If given, filled with the size, mtime and sha256 of each file read, 
+            for save_manifest. The files are hashed when they are read, the program stops if one of 
+            them changes during the read, see check_file_records
     Returns:
         pd.DataFrame: Table with an union of all files, cleaned for empty and duplicate lines. 
     """
 
     # Read all the csv to know if there is a job to continue for this program
-    lst_files = [f for f in listdir(mypath) if isfile(join(mypath, f))]
-    
-    # Read all the input csv
-    df_company_profile2 = pd.DataFrame()
-    for file in lst_files:
-        # Check if the file is a good one
-        expression = "^company_profile2_[0-9]*_[0-9]*.csv$"
-        if re.search(expression, file):
-            df_company_profile2 = df_company_profile2\
-            .append(pd.read_csv(mypath + file, dtype=object))
+    if lst_files is None:
+        lst_files = list_profile2_files(mypath)
+    lst_paths = [join(mypath, file) for file in lst_files]
+    if dict_file_records is not None:
+        dict_file_records.update(get_file_records(mypath, lst_files))
+
+    if streaming_settings is not None:
+        df_company_profile2 = read_profile2_streaming(lst_paths, **dict(STREAMING_SETTINGS, **streaming_settings))
+        if dict_file_records is not None:
+            check_file_records(mypath, dict_file_records)
+        if compact:
+            df_company_profile2 = compact_frame(df_company_profile2)
+        return df_company_profile2
+
+    # Read all the input csv, in the listing order, then union them once
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        lst_df = list(executor.map(lambda path: read_profile2_file(path, engine), lst_paths))
+    if dict_file_records is not None:
+        check_file_records(mypath, dict_file_records)
+    if lst_df:
+        df_company_profile2 = pd.concat(lst_df)
+    else:
+        df_company_profile2 = pd.DataFrame(columns=["ticker", "name", "logo", "weburl", "phone", "ipo"])
     print("Number of rows loaded: ", len(df_company_profile2))
     
     # Drop nan lines
@@ -48,30 +107,98 @@ def read_csv_files(mypath):
     df_company_profile2 = df_company_profile2[columns]
     df_company_profile2.reset_index(inplace=True, drop=True)
     print("Number of rows kept after drop comp name duplicates: ", len(df_company_profile2))
+
+    if compact:
+        df_company_profile2 = compact_frame(df_company_profile2)
     
     return df_company_profile2
 
     
-def read_data_base(session):
+@measured("read_data_base")
+def read_data_base(session, staged=False, method="merge", chunksize=None, snapshot_path=None, 
+                   compact=False, nb_threads=None):
     """ Load and merge tables Company, CompanyContact, CompanyIpo and CompanyDescription
     Args:
         session (sqlalchemy.session): data base session, use to make request
+        staged (bool): If True, load only the companies with the same date Ipo than a row 
+            of the staging table (see stage_company_profile2). They are the only ones 
+            which can match a new row.
+        method (str): "merge" to load the 4 tables and merge them with pandas, 
+            "join" to let the database join them in one request (see get_query_merged_base),
+            "compare" to run both and check they give the same table,
+            "snapshot" to load the tables from the local snapshot at snapshot_path, after
+            fetching the rows added since the last run (see refresh_snapshot),
+            "current" to load the latest state of each company, one row by company, followed by
+            its older names and older contacts, one row each (see get_query_current_base), with 
+            "name" or "contact" in the column alias (empty for the current rows). 
+            The table grows with the history, not with the product of the names and the contacts,
+            and the current values of the companies are matched first
+        chunksize (int): If given, the tables are joined by the database and read by chunks of 
+            chunksize rows, whatever the method. The functions using the merged base accept it. The query 
+            runs once, the next loops read the chunks written to disk, see QueryChunks
+        snapshot_path (str): Location of the snapshot folder, for the method "snapshot". 
+            The snapshot has all the companies, staged is not used
+        compact (bool): Load the tables with compact types if True, see compact_frame
+        nb_threads (int): If given, the 4 tables of the method "merge" (the 3 of "current") are downloaded 
+            at the same time by nb_threads threads, each on its own connection of the engine pool. 
+            Not with staged, the staging table is only seen by the session connection
     Returns:
-        pd.DataFrame: Table with the 4 data table joined on id_company
+        pd.DataFrame: Table with the 4 data table joined on id_company, or QueryChunks if 
+        chunksize is given
     """
 
-    # load tables
-    query = get_query_company(session)
-    df_comp_base = get_pandas_from_query(query, "Company", verbose=False)
-    
-    query = get_query_company_ipo(session)
-    df_comp_ipo_base = get_pandas_from_query(query, "CompanyIpo", verbose=False)
-
-    query = get_query_company_description(session)
-    df_comp_desc_base = get_pandas_from_query(query, "CompanyDescription", verbose=False)
-
-    query = get_query_company_contact(session)
-    df_comp_contact_base = get_pandas_from_query(query, "CompanyContact", verbose=False)
+    # The staging table is temporary, only the session connection sees it
+    connection = None
+    if staged:
+        connection = session.connection()
+        query_id_company = model_requests.get_query_staging_id_company(session)
+
+    if (method in ["join", "compare"]) or (chunksize is not None):
+        query = model_requests.get_query_merged_base(session)
+        if staged:
+            query = query.filter(model_requests.Company.id_company.in_(query_id_company))
+        df_merged_base_join = get_pandas_from_query(query, "Company", verbose=False, connection=connection,
+                                                    chunksize=chunksize, compact=compact)
+        if (method == "join") or (chunksize is not None):
+            return df_merged_base_join
+
+    if method == "current":
+        lst_queries = [(model_requests.get_query_current_base(session), "Company"), 
+                       (model_requests.get_query_name_aliases(session), "CompanyDescription"),
+                       (model_requests.get_query_contact_aliases(session), "CompanyContact")]
+        if staged:
+            # The first column of the queries is the id_company
+            lst_queries = [(query.filter(query.column_descriptions[0]["expr"].in_(query_id_company)), class_name)
+                           for query, class_name in lst_queries]
+        lst_df = read_tables(lst_queries, connection=connection, compact=compact, nb_threads=nb_threads)
+        df_merged_base = pd.concat(lst_df, ignore_index=True)
+        if compact:
+            df_merged_base = compact_frame(df_merged_base)
+        return df_merged_base
+
+    if method == "snapshot":
+        dict_tables = refresh_snapshot(session, snapshot_path, verbose=False)
+        df_comp_base = dict_tables["company"]
+        df_comp_ipo_base = dict_tables["companyipo"]
+        df_comp_desc_base = dict_tables["companydescription"]
+        df_comp_contact_base = dict_tables["companycontact"]
+        if compact:
+            df_comp_base, df_comp_ipo_base, df_comp_desc_base, df_comp_contact_base = \
+                [compact_frame(df) for df in [df_comp_base, df_comp_ipo_base, df_comp_desc_base, df_comp_contact_base]]
+    else:
+        # load tables
+        lst_queries = [(model_requests.get_query_company(session), model_requests.Company, "Company"), 
+                       (model_requests.get_query_company_ipo(session), model_requests.CompanyIpo, "CompanyIpo"),
+                       (model_requests.get_query_company_description(session), model_requests.CompanyDescription, 
+                        "CompanyDescription"),
+                       (model_requests.get_query_company_contact(session), model_requests.CompanyContact, 
+                        "CompanyContact")]
+        if staged:
+            lst_queries = [(query.filter(model.id_company.in_(query_id_company)), model, class_name) 
+                           for query, model, class_name in lst_queries]
+        lst_queries = [(query, class_name) for query, model, class_name in lst_queries]
+        df_comp_base, df_comp_ipo_base, df_comp_desc_base, df_comp_contact_base = \
+            read_tables(lst_queries, connection=connection, compact=compact, nb_threads=nb_threads)
     
     # Merge the data tables 
     df_merged_base =  pd.merge(df_comp_base, df_comp_ipo_base, 
@@ -82,119 +209,441 @@ def read_data_base(session):
     
     df_merged_base =  pd.merge(df_merged_base, df_comp_desc_base, 
                            on='id_company', how='left')
+
+    # The history of the companies repeats the values, compact them once merged
+    if compact:
+        df_merged_base = compact_frame(df_merged_base)
+
+    if method == "compare":
+        is_same = compare_merged_base(df_merged_base, df_merged_base_join)
+        print("Same table with the methods merge and join: {}".format(is_same))
     
     return df_merged_base
 
 
+def read_tables(lst_queries, connection=None, compact=False, nb_threads=None):
+    """ Read the tables of the queries, at the same time if nb_threads is given.
+    Args:
+        lst_queries (list): tuples (query, class name), see get_pandas_from_query
+        connection (sqlalchemy.connection): connection to read with, see get_pandas_from_query. 
+            The tables are read one after the other on it
+        compact (bool): Load the tables with compact types if True, see compact_frame
+        nb_threads (int): Number of threads downloading the tables, each on its own connection 
+            of the engine pool. One table after the other if None
+    Returns:
+        list: the table of each query, in the same order
+    """
+
+    def read_table(query, class_name):
+        return get_pandas_from_query(query, class_name, verbose=False, connection=connection, compact=compact)
+
+    lst_query, lst_class_name = zip(*lst_queries)
+    if (nb_threads is not None) and (connection is None) and is_shared_between_threads(lst_query[0].session.bind):
+        # The downloads wait for the network, they overlap
+        with ThreadPoolExecutor(max_workers=nb_threads) as executor:
+            return list(executor.map(read_table, lst_query, lst_class_name))
+    return list(map(read_table, lst_query, lst_class_name))
+
+
+def compare_merged_base(df_merged_base, df_merged_base_join):
+    """ Check if two merged bases have the same rows, whatever the order of the rows.
+    Args:
+        df_merged_base (pd.Dataframe): Data from the database, merged with pandas
+        df_merged_base_join (pd.Dataframe): Data from the database, joined by the database
+    Returns:
+        bool: True if the tables have the same columns and rows
+    """
+
+    if set(df_merged_base.columns) != set(df_merged_base_join.columns):
+        return False
+
+    # Sort both tables on the ids, empty ids last
+    columns = ["id_company", "id_ipo", "id_contact", "id_description"]
+    df_left = df_merged_base.sort_values(columns).reset_index(drop=True)
+    df_right = df_merged_base_join[df_merged_base.columns].sort_values(columns).reset_index(drop=True)
+    try:
+        pd.testing.assert_frame_equal(df_left, df_right, check_dtype=False)
+        return True
+    except AssertionError:
+        return False
+
+
+def stage_company_profile2(df_company_profile2, session):
+    """ Bulk load the new data into the temporary table staging_profile2, on the session connection,
+    with COPY on PostgreSQL (see copy_insert), with one executemany insert on the other databases.
+    The "not already in the database" filters then run in the database, see 
+    keep_new_names_server_side and keep_new_contacts_server_side. 
+    The table lives as long as the connection, and is replaced at each call.
+    Args:
+        df_company_profile2 (pd.Dataframe): New data to check, table got from the files
+        session (sqlalchemy.session): data base session, use to make request
+    """
+
+    connection = session.connection()
+    staging_table = model_requests.StagingProfile2.__table__
+    staging_table.drop(connection, checkfirst=True)
+    staging_table.create(connection)
+
+    # All the staged values are text, null values are None
+    columns = ["name", "logo", "weburl", "phone", "ipo", "date_description"]
+    df_staging = df_company_profile2[columns].astype(object)
+    df_staging = df_staging.where(df_staging.isna(), df_staging.astype(str))
+    df_staging = df_staging.where(df_staging.notna(), None)
+    df_staging.insert(0, "row_order", range(len(df_staging)))
+
+    if len(df_staging) == 0:
+        return
+    if connection.dialect.name == "postgresql":
+        copy_insert(staging_table, connection, list(df_staging.columns), df_staging.itertuples(index=False))
+    else:
+        connection.execute(staging_table.insert(), df_staging.to_dict("records"))
+
+
+def is_data_base_empty(session):
+    """ Check if the company data table is empty
+    Args:
+        session (sqlalchemy.session): data base session, use to make request
+    Returns:
+        bool: True if there is no company in the database
+    """
+
+    return model_requests.get_query_company(session).first() is None
+
+
+def iter_chunks(df_merged_base):
+    """ Loop on the data from the database, given as one table or by chunks.
+    Args:
+        df_merged_base (pd.Dataframe or QueryChunks): Data from the database
+    Returns:
+        iterable: the tables to loop on
+    """
+
+    if isinstance(df_merged_base, pd.DataFrame):
+        return [df_merged_base]
+    return df_merged_base
+
+
+def drop_alias_rows(df_chunk, alias):
+    """ Drop the alias rows of the data from the database which only carry the other side of a 
+    company, like the older contacts of read_data_base with the method "current" when the names 
+    are checked: their empty names would match the empty names of the new rows. The other rows 
+    are kept, even with empty ids, like a company without contact of the method "merge".
+    Args:
+        df_chunk (pd.Dataframe): Data from the database, see read_data_base
+        alias (str): side of the rows to drop, "contact" when the names are checked, "name" 
+            when the contacts are checked
+    Returns:
+        pd.DataFrame: the rows without this alias, all of them if the table has no column alias
+    """
+
+    if "alias" not in df_chunk.columns:
+        return df_chunk
+    return df_chunk.loc[df_chunk["alias"] != alias]
+
+
+@measured("keep_new_names")
 def keep_new_names(df_company_profile2, df_merged_base, verbose=True):
     """ keep names which are not already in the database
     If the database is empty, the date where the data was get from finnuhub is removed.
     If the database is not empty, that means it is new record and the date has a meaning.
     Args:
         df_company_profile2 (pd.Dataframe): New data to check, table got from the files
-        df_merged_base (pd.Dataframe): Data from the database
+        df_merged_base (pd.Dataframe or QueryChunks): Data from the database, see read_data_base
         verbose (bool): Print extra infos if True
     Returns:
         pd.DataFrame: Table filtered with only new names.
     """
 
     # Check if there is new names from finnhub
-    df_company_new_name = pd.merge(df_company_profile2, df_merged_base[['name']], 
-                                   on=['name'], how='left', indicator='Exist')
-    df_company_new_name = df_company_new_name.loc[df_company_new_name["Exist"] == "left_only"]
-    df_company_new_name.drop("Exist", inplace=True, axis=1) 
-    df_company_new_name.reset_index(inplace=True, drop=True)
+    df_company_new_name = df_company_profile2
+    is_base_empty = True
+    for df_chunk in iter_chunks(df_merged_base):
+        df_names = drop_alias_rows(df_chunk, "contact")
+        df_company_new_name = pd.merge(df_company_new_name, df_names[['name']], 
+                                       on=['name'], how='left', indicator='Exist')
+        df_company_new_name = df_company_new_name.loc[df_company_new_name["Exist"] == "left_only"]
+        df_company_new_name.drop("Exist", inplace=True, axis=1) 
+        is_base_empty = is_base_empty and df_chunk.empty
+    df_company_new_name = df_company_new_name[df_company_profile2.columns].reset_index(drop=True)
     if verbose:
         print("Number of rows kept after check names already in table: ", len(df_company_new_name))
     
     # Delete the date if it is the first time the code run, the date is not the date of a changing
-    if df_merged_base.empty:
+    if is_base_empty:
         df_company_new_name["date_description"] = None
         
     return df_company_new_name
 
 
-def check_status_new_name(df_company_new_name, df_merged_base, verbose=True):
+def resolve_company_ids(df_company_new, df_merged_base, match_name=False, nb_processes=None, 
+                        fuzzy_settings=None):
+    """ For each new row, find the id_company of the first company of the database 
+    with the same date Ipo and either the same phone number or the same weburl 
+    (or the same name, if match_name is True).
+    The database is indexed once by key, then the whole batch is resolved with joins. 
+    Empty keys (None, NaN) never match, like the row by row comparison.
+    Args:
+        df_company_new (pd.Dataframe): Table with the rows to resolve
+        df_merged_base (pd.Dataframe or QueryChunks): Data from the database. By chunks, the 
+            chunks are resolved in order, so the first company still wins
+        match_name (bool): Also match on the name and the date Ipo if True
+        nb_processes (int): If more than 1, the rows and the database are split in shards by 
+            date Ipo, resolved by a pool of nb_processes processes, see get_first_company_ids_sharded
+        fuzzy_settings (dict): If given, the rows without exact match are compared to the companies 
+            with the same date Ipo and a similar phone or weburl, see get_fuzzy_company_ids. 
+            {} for the default settings FUZZY_SETTINGS
+    Returns:
+        pd.Series: id_company of the company found, NaN if none. Same index as df_company_new
+    """
+
+    ids_company = pd.Series(float("nan"), index=df_company_new.index, dtype=object)
+    if df_company_new.empty:
+        return ids_company
+
+    # keys (new rows, database) compared for a match
+    lst_keys = [(["ipo", "phone"], ["date_ipo", "phone"]),
+                (["ipo", "weburl"], ["date_ipo", "weburl"])]
+    if match_name:
+        lst_keys.append((["ipo", "name"], ["date_ipo", "name"]))
+
+    executor = None
+    if (nb_processes is not None) and (nb_processes > 1):
+        executor = ProcessPoolExecutor(max_workers=nb_processes)
+
+    try:
+        df_new = df_company_new.reset_index(drop=True)
+        for df_chunk in iter_chunks(df_merged_base):
+            # Only the rows not found in a previous chunk
+            is_missing = ids_company.isna().values
+            if not is_missing.any():
+                break
+            if executor is None:
+                ids_found = get_first_company_ids(df_new.loc[is_missing], df_chunk, lst_keys)
+            else:
+                ids_found = get_first_company_ids_sharded(df_new.loc[is_missing], df_chunk, lst_keys, 
+                                                          executor, nb_processes * 4)
+            ids_company.iloc[ids_found.index.values] = ids_found.values
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    if fuzzy_settings is not None:
+        # The rows still not found, once all the exact matches are known
+        for df_chunk in iter_chunks(df_merged_base):
+            is_missing = ids_company.isna().values
+            if not is_missing.any():
+                break
+            ids_found = get_fuzzy_company_ids(df_new.loc[is_missing], df_chunk, fuzzy_settings)
+            ids_company.iloc[ids_found.index.values] = ids_found.values
+    return ids_company
+
+
+def get_first_company_ids(df_new, df_merged_base, lst_keys):
+    """ For each new row, find the id_company of the first company of the database matching 
+    one of the keys, see resolve_company_ids.
+    Args:
+        df_new (pd.Dataframe): Table with the rows to resolve
+        df_merged_base (pd.Dataframe): Data from the database
+        lst_keys (list): tuples (columns of the new rows, columns of the database) to compare
+    Returns:
+        pd.Series: id_company of the companies found, indexed by the index of their row in df_new
+    """
+
+    if df_new.empty or df_merged_base.empty:
+        return pd.Series([], dtype=object)
+
+    lst_positions = []
+    for new_keys, base_keys in lst_keys:
+        # Index the database: first position of each key, empty keys dropped
+        df_index = df_merged_base[base_keys].astype(object)
+        df_index.columns = new_keys
+        df_index["position"] = range(len(df_index))
+        df_index = df_index.dropna(subset=new_keys).drop_duplicates(subset=new_keys, keep="first")
+
+        # Join the new rows on the index
+        df_keys = df_new[new_keys].astype(object).dropna()
+        df_keys["row"] = df_keys.index
+        df_found = pd.merge(df_keys, df_index, on=new_keys, how="inner")
+        lst_positions.append(df_found.set_index("row")["position"])
+
+    # The first company of the database matching any of the keys wins
+    sr_position = pd.concat(lst_positions).groupby(level=0).min()
+    return pd.Series(df_merged_base["id_company"].values[sr_position.values], 
+                     index=sr_position.index, dtype=object)
+
+
+def get_ipo_shards(sr_ipo, nb_shards):
+    """ Give a shard number to each date Ipo, from a hash of the date. 
+    The same date always gives the same shard, in the new rows and in the database.
+    Args:
+        sr_ipo (pd.Series): dates Ipo
+        nb_shards (int): Number of shards
+    Returns:
+        np.array: shard number of each date
+    """
+
+    return (pd.util.hash_pandas_object(sr_ipo.astype(str), index=False) % nb_shards).values
+
+
+def get_first_company_ids_sharded(df_new, df_merged_base, lst_keys, executor, nb_shards):
+    """ Same as get_first_company_ids, with the rows and the database split in shards by date Ipo 
+    resolved in parallel. All the keys have the date Ipo, so a row can only match a company of 
+    its shard, and the shards keep the database order, so the first company still wins.
+    Args:
+        df_new (pd.Dataframe): Table with the rows to resolve
+        df_merged_base (pd.Dataframe): Data from the database
+        lst_keys (list): tuples (columns of the new rows, columns of the database) to compare
+        executor (concurrent.futures.Executor): pool resolving the shards
+        nb_shards (int): Number of shards, more than the processes to balance the dates Ipo 
+            with many companies
+    Returns:
+        pd.Series: id_company of the companies found, indexed by the index of their row in df_new
+    """
+
+    if df_new.empty or df_merged_base.empty:
+        return pd.Series([], dtype=object)
+
+    shards_new = get_ipo_shards(df_new["ipo"], nb_shards)
+    shards_base = get_ipo_shards(df_merged_base["date_ipo"], nb_shards)
+    lst_shards = [shard for shard in range(nb_shards) if (shards_new == shard).any()]
+    lst_new = [df_new.loc[shards_new == shard] for shard in lst_shards]
+    lst_base = [df_merged_base.loc[shards_base == shard] for shard in lst_shards]
+
+    lst_ids_found = list(executor.map(get_first_company_ids, lst_new, lst_base, repeat(lst_keys)))
+    lst_ids_found = [ids_found for ids_found in lst_ids_found if not ids_found.empty]
+    if not lst_ids_found:
+        return pd.Series([], dtype=object)
+    # Back in the order of the new rows
+    return pd.concat(lst_ids_found).sort_index()
+
+
+@measured("keep_new_names_server_side")
+def keep_new_names_server_side(session, verbose=True):
+    """ keep names which are not already in the database, with an anti-join run by the database 
+    on the rows staged with stage_company_profile2. Same result as keep_new_names, but only 
+    the rows kept are transferred.
+    Args:
+        session (sqlalchemy.session): data base session, use to make request
+        verbose (bool): Print extra infos if True
+    Returns:
+        pd.DataFrame: Table filtered with only new names.
+    """
+
+    query = model_requests.get_query_staging_new_names(session)
+    df_company_new_name = get_pandas_from_query(query, "StagingProfile2", verbose=False, 
+                                                connection=session.connection())
+    if verbose:
+        print("Number of rows kept after check names already in table: ", len(df_company_new_name))
+
+    # Delete the date if it is the first time the code run, the date is not the date of a changing
+    if is_data_base_empty(session):
+        df_company_new_name["date_description"] = None
+
+    return df_company_new_name
+
+
+def check_status_new_name(df_company_new_name, df_merged_base, verbose=True, nb_processes=None, 
+                          fuzzy_settings=None):
     """ From the record with new names, separate the rows where the name refers to a 
     new company from the rows where the new name refers to a company changing name.
     It is a company changing name if the date Ipo is the same than an existing one and 
     either the phone number or the weburl is the same than the existing one.
+    With fuzzy_settings, a similar phone number or weburl is enough, when none is the same.
     if the name has changed, store the id_company of the corresponding company.
     Args:
         df_company_new_name (pd.Dataframe): Table filtered with only new names.
-        df_merged_base (pd.Dataframe): Data from the database
+        df_merged_base (pd.Dataframe or QueryChunks): Data from the database, see read_data_base
         verbose (bool): Print extra infos if True
+        nb_processes (int): Number of processes resolving the rows by shards of dates Ipo, 
+            see resolve_company_ids. In this process if None
+        fuzzy_settings (dict): Settings of the fuzzy matching, see get_fuzzy_company_ids. 
+            Exact matching only if None
     Returns:
         pd.DataFrame: Table with new companies
         pd.DataFrame: Table where names has changed from exiting companies
     """
 
     # check if the name could have changed
-    start = time.time()
-
-    columns = ['id_company', 'logo', 'weburl', 'phone', 'ipo', 'date_description', 'name']
-    df_comp_to_add = pd.DataFrame(columns=columns)
-    df_comp_names_changed = pd.DataFrame(columns=columns)
-
-    for ind in df_company_new_name.index:
-        name = df_company_new_name.loc[ind, ["name"]].values[0]
-        phone = df_company_new_name.loc[ind, ["phone"]].values[0]
-        weburl = df_company_new_name.loc[ind, ["weburl"]].values[0]
-        ipo = df_company_new_name.loc[ind, ["ipo"]].values[0]
+    with measure_stage("check_status_new_name", rows_in=len(df_company_new_name), verbose=verbose) as record:
+        columns = ['id_company', 'logo', 'weburl', 'phone', 'ipo', 'date_description', 'name']
+        df_comp_to_add = pd.DataFrame(columns=columns)
+        df_comp_names_changed = pd.DataFrame(columns=columns)
 
         # changed if url or phone is the same, and IPO same
-        df_query = df_merged_base.query('@ipo == date_ipo and (@phone == phone or @weburl == weburl)')
-        
-        if df_query.empty:
-            df_comp_to_add = df_comp_to_add.append(df_company_new_name.loc[ind])
-        else:
-            df_query.reset_index(inplace=True, drop=True)
-            id_company = df_query.loc[0, ["id_company"]].values[0]
-            df_company_new_name.at[ind, "id_company"] = id_company
-            df_comp_names_changed = df_comp_names_changed.append(df_company_new_name.loc[ind])
+        ids_company = resolve_company_ids(df_company_new_name, df_merged_base, nb_processes=nb_processes, 
+                                          fuzzy_settings=fuzzy_settings)
+        is_changed = ids_company.notna().values
+        if is_changed.any():
+            df_company_new_name.loc[is_changed, "id_company"] = ids_company[is_changed].astype(float)
+
+        df_comp_to_add = pd.concat([df_comp_to_add, df_company_new_name.loc[~is_changed]])
+        df_comp_names_changed = pd.concat([df_comp_names_changed, df_company_new_name.loc[is_changed]])
+        record["rows_out"] = len(df_comp_to_add) + len(df_comp_names_changed)
 
-    end = time.time()
-    
-    if verbose:
-        if (end - start) < 60:
-            print("Execution time {:.2f} secondes".format(end - start))
-        else:
-            print("Execution time {:.2f} minutes".format((end - start) / 60))
-        print("Number of line(s) treated : {}".format(len(df_company_new_name)))
-            
     return df_comp_to_add, df_comp_names_changed
 
 
 
+@measured("keep_new_contacts")
 def keep_new_contacts(df_company_profile2, df_merged_base, verbose=True):
     """ keep contacts which are not already in the database
     If the database is empty, the date where the data was get from finnuhub is removed.
     If the database is not empty, that means it is new record and the date has a meaning.
     Args:
         df_company_profile2 (pd.Dataframe): New data to check, table got from the files
-        df_merged_base (pd.Dataframe): Data from the database
+        df_merged_base (pd.Dataframe or QueryChunks): Data from the database, see read_data_base
         verbose (bool): Print extra infos if True
     Returns:
         pd.DataFrame: Table filtered with only new names.
     """
 
     # Check if there is new names from finnhub
-    df_company_new_contact = pd.merge(df_company_profile2, df_merged_base[['phone', 'weburl', 'logo']], 
-                                      on=['phone', 'weburl', 'logo'], how='left', indicator='Exist')
-    df_company_new_contact = df_company_new_contact.loc[df_company_new_contact["Exist"] == "left_only"]
-    df_company_new_contact.drop("Exist", inplace=True, axis=1) 
-    df_company_new_contact.reset_index(inplace=True, drop=True)
+    df_company_new_contact = df_company_profile2
+    is_base_empty = True
+    for df_chunk in iter_chunks(df_merged_base):
+        df_contacts = drop_alias_rows(df_chunk, "name")
+        df_company_new_contact = pd.merge(df_company_new_contact, df_contacts[['phone', 'weburl', 'logo']], 
+                                          on=['phone', 'weburl', 'logo'], how='left', indicator='Exist')
+        df_company_new_contact = df_company_new_contact.loc[df_company_new_contact["Exist"] == "left_only"]
+        df_company_new_contact.drop("Exist", inplace=True, axis=1) 
+        is_base_empty = is_base_empty and df_chunk.empty
+    df_company_new_contact = df_company_new_contact[df_company_profile2.columns].reset_index(drop=True)
     if verbose:
         print("Number of rows kept after check contacts already in table: ", len(df_company_new_contact))
     
     # Delete the date if it is the first time the code run, the date is not the date of a changing
-    if df_merged_base.empty:
+    if is_base_empty:
         df_company_new_contact["date_description"] = None
         
     return df_company_new_contact
 
 
-def check_status_new_contact(df_company_new_contact, df_merged_base, verbose=True):
+@measured("keep_new_contacts_server_side")
+def keep_new_contacts_server_side(session, verbose=True):
+    """ keep contacts which are not already in the database, with an anti-join run by the database 
+    on the rows staged with stage_company_profile2. Same result as keep_new_contacts, but only 
+    the rows kept are transferred.
+    Args:
+        session (sqlalchemy.session): data base session, use to make request
+        verbose (bool): Print extra infos if True
+    Returns:
+        pd.DataFrame: Table filtered with only new contacts.
+    """
+
+    query = model_requests.get_query_staging_new_contacts(session)
+    df_company_new_contact = get_pandas_from_query(query, "StagingProfile2", verbose=False, 
+                                                   connection=session.connection())
+    if verbose:
+        print("Number of rows kept after check contacts already in table: ", len(df_company_new_contact))
+
+    # Delete the date if it is the first time the code run, the date is not the date of a changing
+    if is_data_base_empty(session):
+        df_company_new_contact["date_description"] = None
+
+    return df_company_new_contact
+
+
+def check_status_new_contact(df_company_new_contact, df_merged_base, verbose=True, nb_processes=None):
     """ From the record with new contacts, separate the rows where the change refers to a 
     new company from the rows where the change refers to a company changing concacts.
     It is a company changing contact if (the name exists) or ((the date Ipo is the same of 
@@ -202,80 +651,95 @@ def check_status_new_contact(df_company_new_contact, df_merged_base, verbose=Tru
     If the contact has changed, store the id_company of the corresponding company.
     Args:
         df_company_new_contact (pd.Dataframe): Table filtered with only new contacts.
-        df_merged_base (pd.Dataframe): Data from the database
+        df_merged_base (pd.Dataframe or QueryChunks): Data from the database, see read_data_base
         verbose (bool): Print extra infos if True
+        nb_processes (int): Number of processes resolving the rows by shards of dates Ipo, 
+            see resolve_company_ids. In this process if None
     Returns:
         pd.DataFrame: Table with new companies
         pd.DataFrame: Table where contacts has changed from exiting companies
     """
 
     # check if the contact could have changed
-    start = time.time()
-
-    columns = ['id_company', 'logo', 'weburl', 'phone', 'ipo', 'date_description', 'name']
-    df_comp_to_add = pd.DataFrame(columns=columns)
-    df_comp_contact_changed = pd.DataFrame(columns=columns)
-
-    for ind in df_company_new_contact.index:
-        name = df_company_new_contact.loc[ind, ["name"]].values[0]
-        phone = df_company_new_contact.loc[ind, ["phone"]].values[0]
-        weburl = df_company_new_contact.loc[ind, ["weburl"]].values[0]
-        ipo = df_company_new_contact.loc[ind, ["ipo"]].values[0]
-
-        # changed if url or phone is the same, and IPO same
-        condition = '(@ipo == date_ipo and (@phone == phone or @weburl == weburl)) or (@name == name and @ipo == date_ipo)'
-        df_query = df_merged_base.query(condition)
-
-        if df_query.empty:
-            df_comp_to_add = df_comp_to_add.append(df_company_new_contact.loc[ind])
-        else:
-            df_query.reset_index(inplace=True, drop=True)
-            id_company = df_query.loc[0, ["id_company"]].values[0]
-            df_company_new_contact.at[ind, "id_company"] = id_company
-            df_comp_contact_changed = df_comp_contact_changed.append(df_company_new_contact.loc[ind])
+    with measure_stage("check_status_new_contact", rows_in=len(df_company_new_contact), verbose=verbose) as record:
+        columns = ['id_company', 'logo', 'weburl', 'phone', 'ipo', 'date_description', 'name']
+        df_comp_to_add = pd.DataFrame(columns=columns)
+        df_comp_contact_changed = pd.DataFrame(columns=columns)
+
+        # changed if url or phone is the same, and IPO same, or if name and IPO are the same
+        ids_company = resolve_company_ids(df_company_new_contact, df_merged_base, match_name=True, 
+                                          nb_processes=nb_processes)
+        is_changed = ids_company.notna().values
+        if is_changed.any():
+            df_company_new_contact.loc[is_changed, "id_company"] = ids_company[is_changed].astype(float)
+
+        df_comp_to_add = pd.concat([df_comp_to_add, df_company_new_contact.loc[~is_changed]])
+        df_comp_contact_changed = pd.concat([df_comp_contact_changed, df_company_new_contact.loc[is_changed]])
+        record["rows_out"] = len(df_comp_to_add) + len(df_comp_contact_changed)
 
-    end = time.time()
-    
-    if verbose:
-        if (end - start) < 60:
-            print("Execution time {:.2f} secondes".format(end - start))
-        else:
-            print("Execution time {:.2f} minutes".format((end - start) / 60))
-        print("Number of line(s) treated : {}".format(len(df_company_new_contact)))
-            
     return df_comp_to_add, df_comp_contact_changed
 
 
-def set_company_id(df_comp_to_add, df_merged_base):
+@measured("set_company_id")
+def set_company_id(df_comp_to_add, df_merged_base, max_id_company=None, session=None):
     """ Associate a company id to new companies. Get the highest value of id from database.
+    With a PostgreSQL session, the ids are reserved from the sequence company_id_company_seq, 
+    so loaders running at the same time never give the same id. The sequence is first created 
+    if needed and moved after the highest company id (see ensure_company_id_sequence), so the 
+    ids already in the database are never given, whoever gave them.
+    Without a PostgreSQL session, the ids follow the highest id: the next load with a PostgreSQL
+    session moves the sequence after them.
     Args:
         df_comp_to_add (pd.Dataframe): Table with new companies
-        df_merged_base (pd.Dataframe): Data from the database
+        df_merged_base (pd.Dataframe or QueryChunks): Data from the database, see read_data_base
+        max_id_company (int): Highest company id of the database, when df_merged_base is 
+            only a part of it (see get_query_max_id_company). Read from df_merged_base if None
+        session (sqlalchemy.session): data base session, to get the ids from the database 
+            instead of df_merged_base
     Returns:
         pd.DataFrame: Table with new companies,with the column id_company filled
     """
 
+    nb_ids = len(df_comp_to_add)
+    if (session is not None) and (session.bind.dialect.name == "postgresql"):
+        migrations.ensure_company_id_sequence(session.bind, verbose=False)
+
+        # Reserve the ids in one request
+        if nb_ids != 0:
+            query = model_requests.get_query_reserve_id_company(session, nb_ids)
+            lst_id_comp = sorted(id_company for id_company, in query.all())
+            df_comp_to_add["id_company"] = lst_id_comp
+        return df_comp_to_add
+
     # Get all company ids from database to know which are left
-    lst_id_comp = df_merged_base["id_company"].values
-    if len(lst_id_comp) != 0:
-        max_id_company = max(df_merged_base["id_company"].values)
-    else:
+    if (max_id_company is None) and (session is not None):
+        max_id_company = model_requests.get_query_max_id_company(session).scalar() or 0
+    elif max_id_company is None:
         max_id_company = 0
+        for df_chunk in iter_chunks(df_merged_base):
+            lst_id_comp = df_chunk["id_company"].values
+            if len(lst_id_comp) != 0:
+                max_id_company = max(max_id_company, max(lst_id_comp))
         
     # Gives new company id to companies to add
-    for ind in df_comp_to_add.index:
-        df_comp_to_add.at[ind, "id_company"] = max_id_company + 1
-        max_id_company = max_id_company + 1
+    max_id_company = int(max_id_company)
+    df_comp_to_add["id_company"] = range(max_id_company + 1, max_id_company + 1 + nb_ids)
         
     return df_comp_to_add
 
 
-def format_data(df_comp_to_add, df_comp_names_changed):
-    """ From the names changed and the new companies tables, format the data to 
-    match the database tables Company, CompanyDescription, CompanyContact, CompanyIpo
+@measured("format_data")
+def format_data(df_comp_to_add, df_comp_names_changed, df_comp_contact_changed=None):
+    """ From the names changed, the contacts changed and the new companies tables, format the data to 
+    match the database tables Company, CompanyDescription, CompanyContact, CompanyIpo.
+    The new companies found by check_status_new_contact are not used. When their names are new,
+    they are in df_comp_to_add. When their names are in the database with another date Ipo,
+    keep_new_names does not keep them: they are not added, like when only the names are checked.
     Args:
         df_comp_to_add (pd.Dataframe): Table with new companies
         df_comp_names_changed (pd.Dataframe): Table where names has changed from exiting companies
+        df_comp_contact_changed (pd.Dataframe): Table where contacts has changed from exiting companies, 
+            see check_status_new_contact. No contact changed if None
     Returns:
         pd.DataFrame: Table Company
         pd.DataFrame: Table CompanyDescription
@@ -289,12 +753,14 @@ def format_data(df_comp_to_add, df_comp_names_changed):
     # Format dataframe to company_description table
     columns = ["date_description", "name", "id_company"]
     df_comp_description = df_comp_to_add[columns].copy()
-    df_comp_description = df_comp_description.append(df_comp_names_changed[columns])
+    df_comp_description = pd.concat([df_comp_description, df_comp_names_changed[columns]])
 
     # Format dataframe to company_contact table
     columns = ["date_description", "logo", "phone", "weburl", "id_company"]
     df_comp_contact = pd.DataFrame(columns = columns)
     df_comp_contact = df_comp_to_add[columns].copy()
+    if df_comp_contact_changed is not None:
+        df_comp_contact = pd.concat([df_comp_contact, df_comp_contact_changed[columns]])
     df_comp_contact.rename(columns={'date_description': 'date_contact'}, inplace=True)
 
     # Format dataframe to company_ipo table
@@ -302,3 +768,64 @@ def format_data(df_comp_to_add, df_comp_names_changed):
     df_comp_ipo[["date_ipo", "id_company"]] = df_comp_to_add[["ipo", "id_company"]].copy()
 
     return df_company, df_comp_description, df_comp_contact, df_comp_ipo
+
+
+def save_data(df_company, df_comp_description, df_comp_contact, df_comp_ipo, engine, upsert=False, verbose=True,
+              nb_threads=None):
+    """ Save the 4 tables from format_data in one transaction, on one connection, in the order
+    Company, CompanyIpo, CompanyDescription, CompanyContact. If one table fails, nothing is saved,
+    so there is no company without its details. With upsert, the rows already saved are skipped,
+    a re-run on the same data adds nothing.
+    With nb_threads, Company is saved and committed first, then the 3 other tables at the same time, 
+    each in its own transaction on its own connection. If one of them fails, the others are kept:
+    save the same 4 tables again with upsert, resuming from the checkpoint of format_data 
+    (run_pipeline with resume_from="save_data"). The natural key of Company is its id, so the 
+    tables must keep the ids of the first try: running the whole load again would reserve new ids 
+    and save the companies already saved a second time.
+    Args:
+        df_company (pd.DataFrame): Table Company
+        df_comp_description (pd.DataFrame): Table CompanyDescription
+        df_comp_contact (pd.DataFrame): Table CompanyContact
+        df_comp_ipo (pd.DataFrame): Table CompanyIpo
+        engine (sqlalchemy.engine): data base engine, used by session to know which data base is linked
+        upsert (bool): Skip the rows already saved (same natural key) if True, see save_table
+        verbose (bool): Print the number of rows and the time for each table if True
+        nb_threads (int): Number of threads saving the tables after Company, in one transaction if None
+    Returns:
+        pd.DataFrame: For each table, the number of rows added and the time taken in seconds
+    """
+
+    lst_tables = [(df_company, {"id_company": db.Integer}, "company"),
+                  (df_comp_ipo, {"date_ipo": db.String, "id_company": db.Integer}, "companyipo"),
+                  (df_comp_description, {"date_description": db.String, "name": db.String, "id_company": db.Integer}, 
+                   "companydescription"),
+                  (df_comp_contact, {"date_contact": db.String, "weburl": db.String, "logo": db.String, 
+                                     "phone": db.String, "id_company": db.Integer}, "companycontact")]
+
+    nb_rows = sum(len(df_res) for df_res, dtype_res, table_name in lst_tables)
+    with measure_stage("save_data", rows_in=nb_rows) as record_data:
+        if (nb_threads is not None) and is_shared_between_threads(engine):
+            # The details reference the companies, they are saved once the companies are committed
+            def save_in_transaction(table):
+                df_res, dtype_res, table_name = table
+                with engine.begin() as connection:
+                    return save_table(df_res, dtype_res, table_name, connection, upsert=upsert, verbose=False)
+
+            lst_records = [save_in_transaction(lst_tables[0])]
+            with ThreadPoolExecutor(max_workers=nb_threads) as executor:
+                lst_records += list(executor.map(save_in_transaction, lst_tables[1:]))
+        else:
+            with engine.begin() as connection:
+                lst_records = [save_table(df_res, dtype_res, table_name, connection, upsert=upsert, verbose=False)
+                               for df_res, dtype_res, table_name in lst_tables]
+        lst_report = [{"table": table_name, "rows": record["rows_out"], "seconds": record["wall_seconds"]}
+                      for (df_res, dtype_res, table_name), record in zip(lst_tables, lst_records)]
+        record_data["rows_out"] = sum(report["rows"] for report in lst_report)
+
+    df_report = pd.DataFrame(lst_report, columns=["table", "rows", "seconds"])
+    if verbose:
+        for ind in df_report.index:
+            print("Rows added in {}: {} in {:.2f} secondes".format(df_report.loc[ind, "table"], 
+                                                                     df_report.loc[ind, "rows"],
+                                                                     df_report.loc[ind, "seconds"]))
+    return df_report
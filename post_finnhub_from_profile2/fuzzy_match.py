@@ -0,0 +1,224 @@
+# fuzzy_match imports
+from difflib import SequenceMatcher
+
+from .lazy_imports import LazyModule
+
+__all__ = ["FUZZY_SETTINGS", "NAME_STOP_WORDS", "get_text", "normalize_name", "normalize_phone", "normalize_weburl",
+           "get_ngrams", "get_normalized_keys", "get_blocking_keys", "get_candidate_pairs", "get_similarity",
+           "get_fuzzy_company_ids"]
+
+# pandas is imported by the first function using it
+pd = LazyModule("pandas")
+
+
+# Default settings of the fuzzy matching: the similarity thresholds (0 to 1) of the phone, the weburl
+# and the name, the biggest block of the database kept, the companies compared to each row and 
+# the size of the n-grams of the blocking keys. A threshold above 1 turns the column off
+FUZZY_SETTINGS = {"phone": 0.9, "weburl": 0.9, "name": 0.6, "max_block_size": 50, "max_candidates": 5, 
+                  "ngram": 3}
+# Words of the names which do not tell the companies apart
+NAME_STOP_WORDS = r"\b(inc|corp|corporation|co|company|ltd|limited|plc|sa|ag|nv|holdings?|group)\b"
+
+
+def get_text(sr):
+    """ Convert a column to text, the empty values to "".
+    Args:
+        sr (pd.Series): Column of text, maybe categorical
+    Returns:
+        pd.Series: Column of str
+    """
+
+    return sr.astype(object).where(sr.notna(), "").astype(str)
+
+
+def normalize_name(sr_name):
+    """ Normalize the names: lower case, only letters and digits, without the legal forms like "inc".
+    Args:
+        sr_name (pd.Series): names
+    Returns:
+        pd.Series: names normalized
+    """
+
+    sr_name = get_text(sr_name).str.lower().str.replace(r"[^a-z0-9]+", " ", regex=True)
+    sr_name = sr_name.str.replace(NAME_STOP_WORDS, " ", regex=True)
+    return sr_name.str.split().str.join(" ")
+
+
+def normalize_phone(sr_phone):
+    """ Normalize the phone numbers: only the digits, the last 10 ones, so "+1 123-456-7890" 
+    and "1234567890" are the same.
+    Args:
+        sr_phone (pd.Series): phone numbers
+    Returns:
+        pd.Series: phone numbers normalized
+    """
+
+    return get_text(sr_phone).str.replace(r"\D", "", regex=True).str[-10:]
+
+
+def normalize_weburl(sr_weburl):
+    """ Normalize the weburls: lower case, without the scheme, "www." and the last "/".
+    Args:
+        sr_weburl (pd.Series): weburls
+    Returns:
+        pd.Series: weburls normalized
+    """
+
+    sr_weburl = get_text(sr_weburl).str.lower().str.strip()
+    sr_weburl = sr_weburl.str.replace(r"^[a-z]+://", "", regex=True).str.replace(r"^www\.", "", regex=True)
+    return sr_weburl.str.rstrip("/")
+
+
+def get_ngrams(text, ngram):
+    """ Get the n-grams of a text.
+    Args:
+        text (str): text
+        ngram (int): size of the n-grams
+    Returns:
+        set: n-grams of the text, the text itself if it is shorter than ngram
+    """
+
+    if len(text) <= ngram:
+        return {text} if text else set()
+    return {text[i:i + ngram] for i in range(len(text) - ngram + 1)}
+
+
+def get_normalized_keys(df, ipo_column):
+    """ Normalize the columns compared by the fuzzy matching.
+    Args:
+        df (pd.DataFrame): Table with the columns name, phone, weburl and the date Ipo
+        ipo_column (str): column of the date Ipo, "ipo" or "date_ipo"
+    Returns:
+        pd.DataFrame: Table with the columns ipo, name, phone, weburl normalized, same index
+    """
+
+    return pd.DataFrame({"ipo": get_text(df[ipo_column]),
+                         "name": normalize_name(df["name"]),
+                         "phone": normalize_phone(df["phone"]),
+                         "weburl": normalize_weburl(df["weburl"])}, index=df.index)
+
+
+def get_blocking_keys(df_keys, ngram):
+    """ Get the blocking keys of each row: its date Ipo with each n-gram of its name and weburl,
+    and with the last 7 digits of its phone.
+    Args:
+        df_keys (pd.DataFrame): Table normalized, see get_normalized_keys
+        ngram (int): size of the n-grams
+    Returns:
+        pd.DataFrame: Table with the columns row (position of the row), ipo, token. One row by key
+    """
+
+    lst_tokens = [{"n:" + token for token in get_ngrams(name, ngram)} |
+                  {"u:" + token for token in get_ngrams(weburl, ngram)} |
+                  ({"p:" + phone[-7:]} if phone else set())
+                  for name, phone, weburl in zip(df_keys["name"], df_keys["phone"], df_keys["weburl"])]
+    df_blocks = pd.DataFrame({"row": range(len(df_keys)), "ipo": df_keys["ipo"].values, "token": lst_tokens})
+    df_blocks = df_blocks.loc[df_blocks["ipo"] != ""].explode("token").dropna(subset=["token"])
+    return df_blocks
+
+
+def get_candidate_pairs(df_keys_new, df_keys_base, max_block_size=50, max_candidates=5, ngram=3):
+    """ Get the pairs (new row, company of the database) sharing a block: the same date Ipo and
+    the same n-gram of name or weburl, or the same end of phone. The blocks with more than
+    max_block_size companies are too common to tell the companies apart, they are dropped.
+    Each row keeps the max_candidates rows of the database sharing the most blocks with it.
+    So each row is compared to a few companies, never to the whole database.
+    Args:
+        df_keys_new (pd.DataFrame): New rows normalized, see get_normalized_keys
+        df_keys_base (pd.DataFrame): Database normalized, see get_normalized_keys
+        max_block_size (int): Biggest block of the database kept
+        max_candidates (int): Rows of the database kept for each new row
+        ngram (int): size of the n-grams
+    Returns:
+        pd.DataFrame: Table with the columns row (position in df_keys_new), position (position 
+        in df_keys_base) and blocks (number of blocks shared), one row by pair
+    """
+
+    df_blocks_base = get_blocking_keys(df_keys_base, ngram).rename(columns={"row": "position"})
+    sr_block_size = df_blocks_base.groupby(["ipo", "token"])["position"].transform("size")
+    df_blocks_base = df_blocks_base.loc[sr_block_size <= max_block_size]
+
+    df_blocks_new = get_blocking_keys(df_keys_new, ngram)
+    df_pairs = pd.merge(df_blocks_new, df_blocks_base, on=["ipo", "token"], how="inner")
+    df_pairs = df_pairs.groupby(["row", "position"]).size().rename("blocks").reset_index()
+
+    # The rows of the database sharing the most blocks, then the first ones
+    df_pairs = df_pairs.sort_values(["row", "blocks", "position"], ascending=[True, False, True])
+    df_pairs = df_pairs.groupby("row").head(max_candidates)
+    return df_pairs.reset_index(drop=True)
+
+
+def get_similarity(lst_text, lst_text_other, threshold=0.):
+    """ Compare the texts two by two.
+    Args:
+        lst_text (iterable): texts
+        lst_text_other (iterable): texts compared
+        threshold (float): Below the threshold, the similarity is only an upper bound, 
+            faster to compute
+    Returns:
+        list: similarity of each pair, from 0 to 1 (same texts). 0 if one of them is empty
+    """
+
+    lst_similarity = []
+    for text, text_other in zip(lst_text, lst_text_other):
+        if not (text and text_other):
+            similarity = 0.
+        elif text == text_other:
+            similarity = 1.
+        else:
+            # From the fastest upper bound to the exact ratio
+            matcher = SequenceMatcher(None, text, text_other)
+            similarity = matcher.real_quick_ratio()
+            if similarity >= threshold:
+                similarity = matcher.quick_ratio()
+            if similarity >= threshold:
+                similarity = matcher.ratio()
+        lst_similarity.append(similarity)
+    return lst_similarity
+
+
+def get_fuzzy_company_ids(df_new, df_merged_base, settings=None):
+    """ For each new row, find the company of the database with the same date Ipo and either
+    the same normalized phone number or weburl, or a similar phone number or weburl and a similar
+    name: two companies listed the same day often have phone numbers one digit apart, a similar
+    phone alone is not enough. The rows are compared only to
+    the companies of their blocks, see get_candidate_pairs. The most similar company wins,
+    the first one of the database for the same similarity.
+    Args:
+        df_new (pd.Dataframe): Table with the rows to resolve
+        df_merged_base (pd.Dataframe): Data from the database
+        settings (dict): Settings replacing the ones of FUZZY_SETTINGS
+    Returns:
+        pd.Series: id_company of the companies found, indexed by the index of their row in df_new
+    """
+
+    settings = dict(FUZZY_SETTINGS, **(settings or {}))
+    if df_new.empty or df_merged_base.empty:
+        return pd.Series([], dtype=object)
+
+    # Only the companies of the database with the date Ipo of a new row can be in a block
+    df_keys_new = get_normalized_keys(df_new, "ipo")
+    df_merged_base = df_merged_base.loc[get_text(df_merged_base["date_ipo"]).isin(set(df_keys_new["ipo"])).values]
+    df_keys_base = get_normalized_keys(df_merged_base, "date_ipo")
+    df_pairs = get_candidate_pairs(df_keys_new, df_keys_base, settings["max_block_size"], 
+                                   settings["max_candidates"], settings["ngram"])
+    if df_pairs.empty:
+        return pd.Series([], dtype=object)
+
+    # Compare the pairs: the same phone or weburl, or a similar one with a similar name
+    for column in ["phone", "weburl", "name"]:
+        df_pairs[column] = get_similarity(df_keys_new[column].values[df_pairs["row"].values],
+                                          df_keys_base[column].values[df_pairs["position"].values],
+                                          settings[column])
+    is_same = (df_pairs["phone"] >= max(settings["phone"], 1.)) | \
+              (df_pairs["weburl"] >= max(settings["weburl"], 1.))
+    is_similar = ((df_pairs["phone"] >= settings["phone"]) | (df_pairs["weburl"] >= settings["weburl"])) & \
+                 (df_pairs["name"] >= settings["name"])
+    df_pairs = df_pairs.loc[is_same | is_similar]
+
+    # The most similar company wins, then the one with the most similar name, then the first one
+    df_pairs["score"] = df_pairs[["phone", "weburl"]].max(axis=1)
+    df_pairs = df_pairs.sort_values(["row", "score", "name", "position"], ascending=[True, False, False, True])
+    df_pairs = df_pairs.drop_duplicates(subset="row", keep="first")
+    return pd.Series(df_merged_base["id_company"].values[df_pairs["position"].values],
+                     index=df_new.index[df_pairs["row"].values], dtype=object)
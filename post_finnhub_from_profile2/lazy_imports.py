@@ -0,0 +1,45 @@
+# lazy_imports imports
+import importlib
+
+__all__ = ["LazyModule"]
+
+
+class LazyModule:
+    """ Module imported on the first access to one of its attributes. pandas, SQLAlchemy and the modules
+    using them take most of the start of a command, a lazy module keeps them out of the commands which
+    do not need them, like --help or the manifest check.
+    Used like the module: pd = LazyModule("pandas") then pd.DataFrame(...). The import goes through
+    importlib, so two threads using the module for the first time import it once.
+    Args:
+        name (str): Name of the module, like "pandas" or "sqlalchemy.orm", or relative to package 
+            like ".functions"
+        package (str): Package of a relative name, __package__ of the module creating it
+    """
+
+    def __init__(self, name, package=None):
+        self.__dict__["_name"] = name
+        self.__dict__["_package"] = package
+        self.__dict__["_module"] = None
+
+    def get_module(self):
+        """ Import the module, once.
+        Returns:
+            module: the module imported
+        """
+
+        if self._module is None:
+            self.__dict__["_module"] = importlib.import_module(self._name, self._package)
+        return self._module
+
+    def __getattr__(self, attribute):
+        return getattr(self.get_module(), attribute)
+
+    def __setattr__(self, attribute, value):
+        setattr(self.get_module(), attribute, value)
+
+    def __dir__(self):
+        return dir(self.get_module())
+
+    def __repr__(self):
+        state = "imported" if self._module is not None else "not imported"
+        return "<LazyModule {} ({})>".format(self._name, state)
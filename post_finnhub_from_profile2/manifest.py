@@ -0,0 +1,201 @@
+# manifest imports
+import argparse
+import hashlib
+import json
+import re
+import sys
+from datetime import datetime
+from os import listdir, replace, stat
+from os.path import isfile, join
+
+__all__ = ["MANIFEST_FILE_NAME", "PROFILE2_FILE_EXPRESSION", "list_profile2_files", "get_profile2_file_name",
+           "get_profile2_columns", "get_file_hash", "load_manifest", "get_files_to_ingest", "get_file_records",
+           "check_file_records", "save_manifest"]
+
+MANIFEST_FILE_NAME = "profile2_manifest.json"
+PROFILE2_FILE_EXPRESSION = ("^company_profile2_[0-9]*_[0-9]*"
+                            "\\.(csv|csv\\.gz|csv\\.zst|jsonl|jsonl\\.gz|jsonl\\.zst|parquet|feather)$")
+
+
+def list_profile2_files(mypath):
+    """ List the files got from finnhub in the folder, in any format of formats.PROFILE2_FORMATS.
+    Args:
+        mypath (str) : Location of the files folder
+    Returns:
+        list: file names matching "company_profile2_<a>_<b>.<extension>", ordered by a then b. The order 
+        does not depend on the file system, the first row of a name is always the same
+    """
+
+    lst_files = [f for f in listdir(mypath) if isfile(join(mypath, f))]
+    lst_files = [f for f in lst_files if re.search(PROFILE2_FILE_EXPRESSION, f)]
+    return sorted(lst_files, key=lambda f: ([int(number) for number in re.findall("_([0-9]+)", f)], f))
+
+
+def get_profile2_file_name(start, end, extension=".csv"):
+    """ Get the name of the file of the companies start to end got from finnhub.
+    Args:
+        start (int) : Position of the first company in the list of tickers
+        end (int) : Position of the last company, included
+        extension (str) : Extension of the format of the file
+    Returns:
+        str: file name, like "company_profile2_0_499.csv"
+    """
+
+    return "company_profile2_{}_{}{}".format(start, end, extension)
+
+
+def get_profile2_columns():
+    """ Get the columns of the csv got from finnhub profile2
+    Returns:
+        list: column names, in the finnhub order
+    """
+
+    return ["country", "currency", "exchange", "finnhubIndustry", "ipo", "logo", "marketCapitalization",
+            "name", "phone", "shareOutstanding", "ticker", "weburl"]
+
+
+def get_file_hash(file_path):
+    """ Compute the content hash of a file, reading it by blocks.
+    Args:
+        file_path (str) : Location of the file
+    Returns:
+        str: sha256 hexadecimal digest of the file content
+    """
+
+    file_hash = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        for block in iter(lambda: file.read(1024 * 1024), b""):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
+def load_manifest(mypath, manifest_path=None):
+    """ Load the manifest of the files already ingested.
+    Args:
+        mypath (str) : Location of the files folder
+        manifest_path (str) : Location of the manifest, by default "profile2_manifest.json" in the folder
+    Returns:
+        dict: For each file name, its size, mtime, sha256 and the run_id which ingested it
+    """
+
+    if manifest_path is None:
+        manifest_path = join(mypath, MANIFEST_FILE_NAME)
+    if not isfile(manifest_path):
+        return {}
+
+    try:
+        with open(manifest_path) as file:
+            return json.load(file)
+    except ValueError:
+        print('An exception flew by!')
+        print("The manifest {} is not readable - remove it or use the full mode".format(manifest_path))
+        sys.exit(1)
+
+
+def get_files_to_ingest(mypath, manifest, full=False):
+    """ Keep the files which are new or modified since they were ingested.
+    A file with the same size and mtime than in the manifest is not read. Otherwise its content
+    hash is compared, so a file only touched is not ingested again. The mtime of a file only touched 
+    is updated in the manifest, so it is not hashed again once the manifest is saved.
+    Args:
+        mypath (str) : Location of the files folder
+        manifest (dict) : Files already ingested, from load_manifest. Updated in place
+        full (bool) : Keep all the files if True, to rebuild from scratch
+    Returns:
+        list: file names to ingest
+    """
+
+    lst_files = list_profile2_files(mypath)
+    if full:
+        return lst_files
+
+    lst_files_to_ingest = []
+    for file in lst_files:
+        record = manifest.get(file)
+        if record is None:
+            lst_files_to_ingest.append(file)
+            continue
+
+        file_stat = stat(join(mypath, file))
+        if (file_stat.st_size == record["size"]) and (file_stat.st_mtime == record["mtime"]):
+            continue
+        if get_file_hash(join(mypath, file)) != record["sha256"]:
+            lst_files_to_ingest.append(file)
+        else:
+            record["mtime"] = file_stat.st_mtime
+    return lst_files_to_ingest
+
+
+def get_file_records(mypath, lst_files):
+    """ Record the size, mtime and content hash of files, when they are read.
+    Args:
+        mypath (str) : Location of the files folder
+        lst_files (list) : file names
+    Returns:
+        dict: For each file name, its size, mtime and sha256
+    """
+
+    dict_file_records = {}
+    for file in lst_files:
+        file_stat = stat(join(mypath, file))
+        dict_file_records[file] = {"size": file_stat.st_size,
+                                   "mtime": file_stat.st_mtime,
+                                   "sha256": get_file_hash(join(mypath, file))}
+    return dict_file_records
+
+
+def check_file_records(mypath, dict_file_records):
+    """ Check the files did not change since they were recorded with get_file_records, so their
+    hash is the one of the content read. Stop the program if one of them changed.
+    Args:
+        mypath (str) : Location of the files folder
+        dict_file_records (dict) : For each file name, its size, mtime and sha256
+    """
+
+    for file, record in dict_file_records.items():
+        file_stat = stat(join(mypath, file))
+        if (file_stat.st_size != record["size"]) or (file_stat.st_mtime != record["mtime"]):
+            print('An exception flew by!')
+            print("The file {} changed while it was read - run again once it is written".format(file))
+            sys.exit(1)
+
+
+def save_manifest(mypath, manifest, dict_file_records, run_id=None, manifest_path=None):
+    """ Record the files ingested by a run, once their data is saved in the database.
+    The records come from the read of the files (see read_csv_files), not from the files now:
+    a file changed since, for example by the fetcher, is ingested again by the next run.
+    Args:
+        mypath (str) : Location of the files folder
+        manifest (dict) : Files already ingested, from load_manifest. Updated in place
+        dict_file_records (dict) : For each file ingested by the run, its size, mtime and sha256 
+            when it was read, see get_file_records
+        run_id (str) : Run identifier, by default the current date and time
+        manifest_path (str) : Location of the manifest, by default "profile2_manifest.json" in the folder
+    Returns:
+        dict: The manifest updated
+    """
+
+    if manifest_path is None:
+        manifest_path = join(mypath, MANIFEST_FILE_NAME)
+    if run_id is None:
+        run_id = datetime.now().strftime("%Y%m%d_%H%M%S")
+
+    for file, record in dict_file_records.items():
+        manifest[file] = dict(record, run_id=run_id)
+
+    # Write in a temporary file first, so a crash never leaves a truncated manifest
+    with open(manifest_path + ".tmp", "w") as file:
+        json.dump(manifest, file, indent=1, sort_keys=True)
+    replace(manifest_path + ".tmp", manifest_path)
+    return manifest
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="List the profile2 files to ingest in a folder.")
+    parser.add_argument("mypath", help="Location of the files folder")
+    parser.add_argument("--full", action="store_true", help="List all the files, to rebuild from scratch")
+    args = parser.parse_args()
+
+    manifest = load_manifest(args.mypath)
+    for file in get_files_to_ingest(args.mypath, manifest, full=args.full):
+        print(file)
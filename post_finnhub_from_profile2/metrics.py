@@ -0,0 +1,287 @@
+# metrics imports
+import functools
+import json
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from os import replace
+
+# resource does not exist on Windows, the peak RSS is not recorded there
+try:
+    import resource
+except ImportError:
+    resource = None
+
+__all__ = ["METRICS_SINKS", "METRICS_PREFIX", "count_round_trip", "get_round_trips", "get_peak_rss", "add_metrics_sink",
+           "remove_metrics_sink", "measure_stage", "get_rows", "measured", "get_overlap", "emit_record", "PrintSink",
+           "ListSink", "JsonLinesSink", "PrometheusTextfileSink"]
+
+# Sinks receiving each stage record, see add_metrics_sink
+METRICS_SINKS = []
+METRICS_PREFIX = "profile2_stage"
+metrics_lock = threading.Lock()
+dict_round_trips = {"count": 0}
+
+
+def count_round_trip(*args):
+    """ Count one round trip to the data base, for every statement executed by any engine.
+    connections.py listens to the statements of the engines with it (see listen_round_trips), so 
+    SQLAlchemy is not imported here. COPY goes through the raw connection, copy_insert counts it by 
+    calling this function.
+    """
+
+    with metrics_lock:
+        dict_round_trips["count"] += 1
+
+
+def get_round_trips():
+    """ Get the number of statements sent to the data base since the process started.
+    Returns:
+        int: number of round trips
+    """
+
+    with metrics_lock:
+        return dict_round_trips["count"]
+
+
+def get_peak_rss():
+    """ Get the peak resident set size of the process so far.
+    Returns:
+        int: peak RSS in bytes, None if not available
+    """
+
+    if resource is None:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux gives kilobytes, macOS gives bytes
+    return peak_rss if sys.platform == "darwin" else peak_rss * 1024
+
+
+def add_metrics_sink(sink):
+    """ Send the record of each stage to the sink, from now on.
+    Args:
+        sink: Object with a write(record) method, like JsonLinesSink or PrometheusTextfileSink
+    Returns:
+        The sink, to remove it later
+    """
+
+    with metrics_lock:
+        METRICS_SINKS.append(sink)
+    return sink
+
+
+def remove_metrics_sink(sink):
+    """ Stop sending the stage records to the sink.
+    Args:
+        sink: Sink added with add_metrics_sink
+    """
+
+    with metrics_lock:
+        if sink in METRICS_SINKS:
+            METRICS_SINKS.remove(sink)
+
+
+@contextmanager
+def measure_stage(stage, rows_in=None, verbose=False):
+    """ Measure a stage of the pipeline and send its record to the sinks.
+    The record has the wall time, the CPU time of the process, the rows in and out,
+    the peak RSS of the process and the number of round trips to the data base during the stage.
+    It has the start and the end (timestamp) of the stage and its thread, to see the stages
+    run at the same time, see get_overlap.
+    Set record["rows_out"] in the block, the status is "error" if the block raises.
+    Args:
+        stage (str): Stage name, like "keep_new_names"
+        rows_in (int): Number of rows given to the stage
+        verbose (bool): Print the record with PrintSink too
+    Yields:
+        dict: record of the stage
+    """
+
+    record = {"stage": stage, "rows_in": rows_in, "rows_out": None, "status": "ok", 
+              "thread": threading.current_thread().name, "start_timestamp": time.time()}
+    start_wall = time.perf_counter()
+    start_cpu = time.process_time()
+    start_round_trips = get_round_trips()
+    try:
+        yield record
+    except BaseException:
+        record["status"] = "error"
+        raise
+    finally:
+        record["wall_seconds"] = time.perf_counter() - start_wall
+        record["cpu_seconds"] = time.process_time() - start_cpu
+        record["peak_rss_bytes"] = get_peak_rss()
+        record["db_round_trips"] = get_round_trips() - start_round_trips
+        record["timestamp"] = time.time()
+        emit_record(record, verbose=verbose)
+
+
+def get_rows(result):
+    """ Count the rows of the result of a stage: the length of a table, or the sum of the lengths
+    of the tables of a tuple.
+    Args:
+        result: Result of the stage
+    Returns:
+        int: number of rows, None if the result has no table
+    """
+
+    # pandas is imported here, the commands without stage start without it
+    import pandas as pd
+    lst_results = result if isinstance(result, tuple) else (result,)
+    lst_tables = [df for df in lst_results if isinstance(df, (pd.DataFrame, pd.Series))]
+    if not lst_tables:
+        return None
+    return sum(len(df) for df in lst_tables)
+
+
+def measured(stage):
+    """ Decorator measuring each call of the function as a stage, see measure_stage.
+    The rows in are the rows of the first argument if it is a table, the rows out the rows
+    of the result, see get_rows.
+    Args:
+        stage (str): Stage name, like "keep_new_names"
+    Returns:
+        function: decorator
+    """
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            rows_in = get_rows(args[0]) if args else None
+            with measure_stage(stage, rows_in=rows_in) as record:
+                result = function(*args, **kwargs)
+                record["rows_out"] = get_rows(result)
+            return result
+        return wrapper
+    return decorator
+
+
+def get_overlap(lst_records):
+    """ Measure how much the stages overlapped: the sum of their wall times against the time 
+    during which at least one of them was running.
+    Args:
+        lst_records (list): records of the stages, see measure_stage and ListSink
+    Returns:
+        dict: busy_seconds (sum of the wall times), elapsed_seconds (union of the stage intervals)
+        and overlap_ratio (busy over elapsed, 1 if the stages ran one after the other)
+    """
+
+    lst_intervals = sorted((record["start_timestamp"], record["timestamp"]) for record in lst_records)
+    busy_seconds = sum(end - start for start, end in lst_intervals)
+    elapsed_seconds = 0.
+    current_start, current_end = None, None
+    for start, end in lst_intervals:
+        if (current_end is None) or (start > current_end):
+            if current_end is not None:
+                elapsed_seconds += current_end - current_start
+            current_start, current_end = start, end
+        else:
+            current_end = max(current_end, end)
+    if current_end is not None:
+        elapsed_seconds += current_end - current_start
+    overlap_ratio = busy_seconds / elapsed_seconds if elapsed_seconds > 0 else 1.
+    return {"busy_seconds": busy_seconds, "elapsed_seconds": elapsed_seconds, "overlap_ratio": overlap_ratio}
+
+
+def emit_record(record, verbose=False):
+    """ Send a stage record to the sinks.
+    Args:
+        record (dict): record of the stage, see measure_stage
+        verbose (bool): Print the record with PrintSink too
+    """
+
+    with metrics_lock:
+        lst_sinks = list(METRICS_SINKS)
+    if verbose and not any(isinstance(sink, PrintSink) for sink in lst_sinks):
+        lst_sinks.append(PrintSink())
+    for sink in lst_sinks:
+        sink.write(record)
+
+
+class PrintSink:
+    """ Print the time and the rows of each stage, in secondes or minutes. """
+
+    def write(self, record):
+        duration = record["wall_seconds"]
+        if duration < 60:
+            print("Execution time of {}: {:.2f} secondes".format(record["stage"], duration))
+        else:
+            print("Execution time of {}: {:.2f} minutes".format(record["stage"], duration / 60))
+        if record["rows_out"] is not None:
+            print("Number of line(s) treated for {} : {}".format(record["stage"], record["rows_out"]))
+
+
+class ListSink:
+    """ Keep the records in memory, in the list records. """
+
+    def __init__(self):
+        self.records = []
+
+    def write(self, record):
+        self.records.append(dict(record))
+
+
+class JsonLinesSink:
+    """ Append each record as one json line to a file.
+    Args:
+        file_path (str): Location of the file, created if needed
+        run_id (str): Run identifier written in each line, by default the current date and time
+    """
+
+    def __init__(self, file_path, run_id=None):
+        self.file_path = file_path
+        self.run_id = run_id or datetime.now().strftime("%Y%m%d_%H%M%S")
+        self.lock = threading.Lock()
+
+    def write(self, record):
+        line = json.dumps(dict(record, run_id=self.run_id))
+        with self.lock:
+            with open(self.file_path, "a") as file:
+                file.write(line + "\n")
+
+
+class PrometheusTextfileSink:
+    """ Write the last record of each stage in a file for the textfile collector of the
+    Prometheus node exporter. The file is rewritten at each record, in a temporary file first
+    so the collector never reads a truncated file.
+    Args:
+        file_path (str): Location of the file, it should end with ".prom"
+        job (str): Value of the label job of the metrics
+    """
+
+    # metric name, record key, help
+    METRICS = [("wall_seconds", "wall_seconds", "Wall time of the stage"),
+               ("cpu_seconds", "cpu_seconds", "CPU time of the process during the stage"),
+               ("rows_in", "rows_in", "Rows given to the stage"),
+               ("rows_out", "rows_out", "Rows returned by the stage"),
+               ("peak_rss_bytes", "peak_rss_bytes", "Peak resident set size of the process"),
+               ("db_round_trips", "db_round_trips", "Statements sent to the data base during the stage"),
+               ("last_run_timestamp_seconds", "timestamp", "End of the last run of the stage"),
+               ("success", "status", "1 if the last run of the stage succeeded")]
+
+    def __init__(self, file_path, job="post_finnhub_from_profile2"):
+        self.file_path = file_path
+        self.job = job
+        self.dict_records = {}
+        self.lock = threading.Lock()
+
+    def write(self, record):
+        with self.lock:
+            self.dict_records[record["stage"]] = dict(record)
+            lst_lines = []
+            for name, key, help_text in self.METRICS:
+                lst_lines.append("# HELP {}_{} {}".format(METRICS_PREFIX, name, help_text))
+                lst_lines.append("# TYPE {}_{} gauge".format(METRICS_PREFIX, name))
+                for stage, stage_record in self.dict_records.items():
+                    value = stage_record.get(key)
+                    if key == "status":
+                        value = int(value == "ok")
+                    if value is None:
+                        continue
+                    lst_lines.append('{}_{}{{job="{}",stage="{}"}} {}'.format(METRICS_PREFIX, name, self.job,
+                                                                              stage, value))
+            with open(self.file_path + ".tmp", "w") as file:
+                file.write("\n".join(lst_lines) + "\n")
+            replace(self.file_path + ".tmp", self.file_path)
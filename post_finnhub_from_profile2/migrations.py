@@ -0,0 +1,166 @@
+# migrations imports
+import argparse
+import os
+import re
+import sys
+from sqlalchemy import exc, text
+from sqlalchemy.schema import CreateIndex
+
+from .connections import data_base_connection
+from .model_requests import CompanyContact, CompanyDescription, CompanyIpo
+
+__all__ = ["create_company_id_sequence", "ensure_company_id_sequence", "get_model_indexes", "create_indexes",
+           "delete_duplicates"]
+
+
+def create_company_id_sequence(engine, verbose=True):
+    """ Create the sequence company_id_company_seq giving the new company ids, if it does not exist,
+    and move it after the highest company id of the database, if it is not already after it. 
+    PostgreSQL only. An existing sequence is moved too: the SERIAL sequence of the primary key,
+    or the one created at 1 with the tables by create_all, while the ids were inserted explicitly.
+    Args:
+        engine (sqlalchemy.engine): data base engine, used by session to know which data base is linked
+        verbose (bool): Print that the sequence is ready if True
+    """
+
+    try:
+        with engine.begin() as connection:
+            connection.execute(text("CREATE SEQUENCE IF NOT EXISTS company_id_company_seq "
+                                    "OWNED BY company.id_company"))
+            # Lock the table, no company can be added while the sequence is set
+            connection.execute(text("LOCK TABLE company IN EXCLUSIVE MODE"))
+            connection.execute(text("SELECT setval('company_id_company_seq', "
+                                    "GREATEST((SELECT COALESCE(MAX(id_company), 0) FROM company) + 1, "
+                                    "(SELECT CASE WHEN is_called THEN last_value + 1 ELSE last_value END "
+                                    "FROM company_id_company_seq)), false)"))
+        if verbose:
+            print("Sequence company_id_company_seq ready")
+
+    except exc.OperationalError:
+        print('An exception flew by!')
+        print("The connection with the data table failed - check your permissions")
+        sys.exit(1)
+
+
+def ensure_company_id_sequence(engine, verbose=True):
+    """ Create the sequence company_id_company_seq if it does not exist yet and move it after the 
+    highest company id, see create_company_id_sequence. Run at the start of every load: the ids 
+    given without the sequence (by set_company_id without a PostgreSQL session) are skipped. 
+    Nothing is done if the database is not PostgreSQL.
+    Args:
+        engine (sqlalchemy.engine): data base engine, used by session to know which data base is linked
+        verbose (bool): Print that the sequence is ready if True
+    """
+
+    if engine.dialect.name != "postgresql":
+        return
+    create_company_id_sequence(engine, verbose=verbose)
+
+
+def get_model_indexes():
+    """ Get the indexes declared on the tables CompanyDescription, CompanyContact and CompanyIpo,
+    the unique indexes of their natural keys included.
+    Returns:
+        list: sqlalchemy.Index of the tables
+    """
+
+    lst_tables = [CompanyDescription.__table__, CompanyContact.__table__, CompanyIpo.__table__]
+    return [index for table in lst_tables for index in sorted(table.indexes, key=lambda index: index.name)]
+
+
+def create_indexes(engine, verbose=True):
+    """ Create the indexes declared on the models in an existing database, if they do not exist.
+    On PostgreSQL they are built CONCURRENTLY, the tables can still be written while they are built. 
+    A concurrent build which failed leaves an invalid index, it is dropped and built again.
+    A unique index can not be built on a table with duplicates, run delete_duplicates first.
+    Args:
+        engine (sqlalchemy.engine): data base engine, used by session to know which data base is linked
+        verbose (bool): Print each index created if True
+    """
+
+    is_postgresql = engine.dialect.name == "postgresql"
+    try:
+        # CONCURRENTLY can not run in a transaction
+        with engine.connect() as connection:
+            if is_postgresql:
+                connection = connection.execution_options(isolation_level="AUTOCOMMIT")
+            for index in get_model_indexes():
+                # "CREATE [UNIQUE] INDEX [CONCURRENTLY] IF NOT EXISTS name ON table (expressions)"
+                ddl = str(CreateIndex(index).compile(dialect=engine.dialect))
+                ddl = re.sub(r"^CREATE (UNIQUE )?INDEX ", 
+                             lambda match: "CREATE {}INDEX {}IF NOT EXISTS ".format(match.group(1) or "", 
+                                                                                  "CONCURRENTLY " * is_postgresql),
+                             ddl)
+                if is_postgresql:
+                    is_invalid = connection.execute(text("SELECT 1 FROM pg_class c JOIN pg_index i "
+                                                         "ON i.indexrelid = c.oid "
+                                                         "WHERE c.relname = :name AND NOT i.indisvalid"),
+                                                    {"name": index.name}).first() is not None
+                    if is_invalid:
+                        connection.execute(text("DROP INDEX CONCURRENTLY IF EXISTS {}".format(index.name)))
+                connection.execute(text(ddl))
+                if verbose:
+                    print("Index {} ready".format(index.name))
+
+    except exc.IntegrityError:
+        print('An exception flew by!')
+        print("The table {} has duplicates - run delete_duplicates first".format(index.table.name))
+        sys.exit(1)
+    except exc.OperationalError:
+        print('An exception flew by!')
+        print("The connection with the data table failed - check your permissions")
+        sys.exit(1)
+
+
+def delete_duplicates(engine, verbose=True):
+    """ Delete the rows of CompanyDescription, CompanyContact and CompanyIpo saved twice, the same 
+    natural key (see the unique indexes of the models). The first row saved, the lowest primary key, 
+    is kept. Run it once before creating the unique indexes on an existing database.
+    Args:
+        engine (sqlalchemy.engine): data base engine, used by session to know which data base is linked
+        verbose (bool): Print the number of rows deleted by table if True
+    Returns:
+        dict: For each table name, the number of rows deleted
+    """
+
+    dict_deleted = {}
+    try:
+        with engine.begin() as connection:
+            for index in get_model_indexes():
+                if not index.unique:
+                    continue
+                table = index.table
+                primary_key = list(table.primary_key.columns)[0]
+                expressions = ", ".join(str(expression.compile(dialect=engine.dialect, 
+                                                               compile_kwargs={"literal_binds": True}))
+                                        for expression in index.expressions)
+                result = connection.execute(text("DELETE FROM {table} WHERE {key} NOT IN "
+                                                 "(SELECT MIN({key}) FROM {table} GROUP BY {expressions})"\
+.format(table=table.name, key=primary_key.name, expressions=expressions)))
+                dict_deleted[table.name] = result.rowcount
+                if verbose:
+                    print("Rows deleted in {}: {}".format(table.name, result.rowcount))
+
+    except exc.OperationalError:
+        print('An exception flew by!')
+        print("The connection with the data table failed - check your permissions")
+        sys.exit(1)
+    return dict_deleted
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Create the database objects used by the loader.")
+    parser.add_argument("objects", nargs="?", choices=["all", "sequence", "indexes", "deduplicate"], 
+                        default="all", help="Objects to create, all of them by default. deduplicate deletes "
+                                            "the rows saved twice, before creating the unique indexes")
+    args = parser.parse_args()
+
+    # read global connection passwords from bash environment
+    session, engine = data_base_connection(os.environ["POSTGRES_USER"], os.environ["POSTGRES_PASSWORD"],
+                                           os.environ["HOST"], os.environ["BD_NAME"])
+    if args.objects in ["all", "sequence"]:
+        create_company_id_sequence(engine)
+    if args.objects == "deduplicate":
+        delete_duplicates(engine)
+    if args.objects in ["all", "indexes"]:
+        create_indexes(engine)
@@ -1,15 +1,23 @@
 # Class packages
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, Integer, String, Float, Boolean
+from sqlalchemy import Column, Integer, String, Float, Sequence, Index
 Base = declarative_base()
+company_id_sequence = Sequence("company_id_company_seq")
 # Queries packages
-from sqlalchemy import or_, and_, func, distinct
+from sqlalchemy import and_, func, null, cast, literal
 import sys
 
+__all__ = ["Base", "company_id_sequence", "Company", "CompanyDescription", "CompanyContact", "StagingProfile2",
+           "CompanyIpo", "get_query_company", "get_query_company_ipo", "get_query_company_contact",
+           "get_query_company_description", "get_query_merged_base", "get_query_ranked_history",
+           "get_query_current_base", "get_query_name_aliases", "get_query_contact_aliases",
+           "get_query_reserve_id_company", "get_query_staging_new_names", "get_query_staging_new_contacts",
+           "get_query_staging_id_company", "get_query_max_id_company"]
+
 
 class Company(Base):
     __tablename__ = 'company'
-    id_company = Column("id_company", Integer, primary_key=True)
+    id_company = Column("id_company", Integer, company_id_sequence, primary_key=True)
     id_naic_sector = Column("id_naic_sector", Integer)
     id_finnhub_classification = Column("id_finnhub_classification", Integer)
     id_gics_sector = Column("id_gics_sector", Integer)
@@ -17,6 +25,9 @@ class Company(Base):
 
 class CompanyDescription(Base):
     __tablename__ = 'companydescription'
+    # Join on the company, lookup by name
+    __table_args__ = (Index("ix_companydescription_id_company", "id_company"),
+                      Index("ix_companydescription_name", "name"))
     id_description = Column("id_description", Integer, primary_key=True)
     name = Column("name", String)
     description = Column("description", String)
@@ -26,22 +37,52 @@ class CompanyDescription(Base):
 
 class CompanyContact(Base):
     __tablename__ = 'companycontact'
+    # Join on the company, lookup by phone and weburl
+    __table_args__ = (Index("ix_companycontact_id_company", "id_company"),
+                      Index("ix_companycontact_phone", "phone"),
+                      Index("ix_companycontact_weburl", "weburl"))
     id_contact = Column("id_contact", Integer, primary_key=True)
     weburl = Column("weburl", String)
     logo = Column("logo", String)
     phone = Column("phone", String)
     date_contact = Column("date_contact", String)
     id_company = Column("id_company", Integer)
-    
+
+
+class StagingProfile2(Base):
+    __tablename__ = 'staging_profile2'
+    __table_args__ = {'prefixes': ['TEMPORARY']}
+    row_order = Column("row_order", Integer, primary_key=True)
+    name = Column("name", String)
+    logo = Column("logo", String)
+    weburl = Column("weburl", String)
+    phone = Column("phone", String)
+    ipo = Column("ipo", String)
+    date_description = Column("date_description", String)
+
 
 class CompanyIpo(Base):
     __tablename__ = 'companyipo'
+    # Join on the company, lookup by date Ipo
+    __table_args__ = (Index("ix_companyipo_id_company", "id_company"),
+                      Index("ix_companyipo_date_ipo", "date_ipo"))
     id_ipo = Column("id_ipo", Integer, primary_key=True)
     number_shares = Column("number_shares", Integer)
     avg_share_price = Column("avg_share_price", Float)
     date_ipo = Column("date_ipo", String)
     id_company = Column("id_company", Integer)
-    
+
+
+# Natural keys of the history tables, so the upsert mode of save_table skips the rows already saved.
+# The empty values are compared as '', two NULL are never the same in a unique index
+Index("uq_companydescription_natural_key", CompanyDescription.id_company, 
+      func.coalesce(CompanyDescription.name, ""), func.coalesce(CompanyDescription.date_description, ""), 
+      unique=True)
+Index("uq_companycontact_natural_key", CompanyContact.id_company, func.coalesce(CompanyContact.logo, ""),
+      func.coalesce(CompanyContact.weburl, ""), func.coalesce(CompanyContact.phone, ""), 
+      func.coalesce(CompanyContact.date_contact, ""), unique=True)
+Index("uq_companyipo_natural_key", CompanyIpo.id_company, func.coalesce(CompanyIpo.date_ipo, ""), unique=True)
+
 
 def get_query_company(session):
     """ Get all the values in company data table
@@ -139,3 +180,327 @@ def get_query_company_description(session):
         print('The attributes for the class {} are not good, or the query\
 code syntax has an error'.format(class_name))
         sys.exit(1)
+
+
+def get_query_merged_base(session):
+    """ Get the tables Company, CompanyIpo, CompanyContact and CompanyDescription joined on id_company,
+    with a left join from Company, in one request. The columns are in the order of the pandas merge 
+    of read_data_base, and the rows are ordered by ids.
+    Args:
+        session (sqlalchemy.session): data base session, use to make request
+    Return:
+        str: string conataining the sql request to send to postgres
+    """
+
+    # ---  Set queries ---
+    class_name = "Company"
+    try:
+        query = session.query(Company.id_company,
+                              CompanyIpo.id_ipo,
+                              CompanyIpo.date_ipo,
+                              CompanyContact.id_contact,
+                              CompanyContact.logo,
+                              CompanyContact.weburl,
+                              CompanyContact.phone,
+                              CompanyContact.date_contact,
+                              CompanyDescription.id_description,
+                              CompanyDescription.name,
+                              CompanyDescription.date_description)\
+            .outerjoin(CompanyIpo, CompanyIpo.id_company == Company.id_company)\
+            .outerjoin(CompanyContact, CompanyContact.id_company == Company.id_company)\
+            .outerjoin(CompanyDescription, CompanyDescription.id_company == Company.id_company)\
+            .order_by(Company.id_company,
+                      CompanyIpo.id_ipo,
+                      CompanyContact.id_contact,
+                      CompanyDescription.id_description)
+        return query
+
+    except AttributeError:
+        print('An exception flew by!')
+        print('The attributes for the class {} are not good, or the query\
+code syntax has an error'.format(class_name))
+        sys.exit(1)
+
+
+def get_query_ranked_history(session, model, id_column, date_column=None):
+    """ Get the rows of a history table with their rank in the history of their company, 
+    1 for the latest one: the latest date first, the rows without date (first load) last, 
+    then the highest id. Built with the window function row_number, on PostgreSQL and SQLite.
+    Args:
+        session (sqlalchemy.session): data base session, use to make request
+        model (Base): history table, like CompanyDescription
+        id_column (sqlalchemy.Column): primary key of the table
+        date_column (sqlalchemy.Column): date of the change, None if the table has none
+    Return:
+        sqlalchemy.sql.Subquery: subquery with the columns of the table and the column "rank"
+    """
+
+    lst_order = [] if date_column is None else [func.coalesce(date_column, "").desc()]
+    rank = func.row_number().over(partition_by=model.id_company, order_by=lst_order + [id_column.desc()])
+    return session.query(model, rank.label("rank")).subquery()
+
+
+def get_query_current_base(session):
+    """ Get the current state of each company: Company with its latest CompanyIpo, CompanyContact 
+    and CompanyDescription (see get_query_ranked_history), one row by company however long its 
+    history is. The columns are the ones of get_query_merged_base, the rows are ordered by id_company.
+    Args:
+        session (sqlalchemy.session): data base session, use to make request
+    Return:
+        str: string conataining the sql request to send to postgres
+    """
+
+    # ---  Set queries ---
+    class_name = "Company"
+    try:
+        ipo = get_query_ranked_history(session, CompanyIpo, CompanyIpo.id_ipo)
+        contact = get_query_ranked_history(session, CompanyContact, CompanyContact.id_contact, 
+                                           CompanyContact.date_contact)
+        description = get_query_ranked_history(session, CompanyDescription, CompanyDescription.id_description, 
+                                               CompanyDescription.date_description)
+        query = session.query(Company.id_company,
+                              ipo.c.id_ipo,
+                              ipo.c.date_ipo,
+                              contact.c.id_contact,
+                              contact.c.logo,
+                              contact.c.weburl,
+                              contact.c.phone,
+                              contact.c.date_contact,
+                              description.c.id_description,
+                              description.c.name,
+                              description.c.date_description)\
+            .outerjoin(ipo, and_(ipo.c.id_company == Company.id_company, ipo.c.rank == 1))\
+            .outerjoin(contact, and_(contact.c.id_company == Company.id_company, contact.c.rank == 1))\
+            .outerjoin(description, and_(description.c.id_company == Company.id_company, description.c.rank == 1))\
+            .order_by(Company.id_company)
+        return query
+
+    except AttributeError:
+        print('An exception flew by!')
+        print('The attributes for the class {} are not good, or the query\
+code syntax has an error'.format(class_name))
+        sys.exit(1)
+
+
+def get_query_name_aliases(session):
+    """ Get the older names of the companies (not the latest one, see get_query_current_base), 
+    one row by name with the current date Ipo of the company. The contact columns are empty.
+    The columns are the ones of get_query_merged_base and the column alias, "name" on every row,
+    the rows are ordered by ids.
+    Args:
+        session (sqlalchemy.session): data base session, use to make request
+    Return:
+        str: string conataining the sql request to send to postgres
+    """
+
+    # ---  Set queries ---
+    class_name = "CompanyDescription"
+    try:
+        ipo = get_query_ranked_history(session, CompanyIpo, CompanyIpo.id_ipo)
+        description = get_query_ranked_history(session, CompanyDescription, CompanyDescription.id_description, 
+                                               CompanyDescription.date_description)
+        query = session.query(description.c.id_company,
+                              ipo.c.id_ipo,
+                              ipo.c.date_ipo,
+                              cast(null(), Integer).label("id_contact"),
+                              cast(null(), String).label("logo"),
+                              cast(null(), String).label("weburl"),
+                              cast(null(), String).label("phone"),
+                              cast(null(), String).label("date_contact"),
+                              description.c.id_description,
+                              description.c.name,
+                              description.c.date_description,
+                              literal("name", String).label("alias"))\
+            .outerjoin(ipo, and_(ipo.c.id_company == description.c.id_company, ipo.c.rank == 1))\
+            .filter(description.c.rank > 1)\
+            .order_by(description.c.id_company, description.c.id_description)
+        return query
+
+    except AttributeError:
+        print('An exception flew by!')
+        print('The attributes for the class {} are not good, or the query\
+code syntax has an error'.format(class_name))
+        sys.exit(1)
+
+
+def get_query_contact_aliases(session):
+    """ Get the older contacts of the companies (not the latest one, see get_query_current_base), 
+    one row by contact with the current date Ipo of the company. The description columns are empty.
+    The columns are the ones of get_query_merged_base and the column alias, "contact" on every row,
+    the rows are ordered by ids.
+    Args:
+        session (sqlalchemy.session): data base session, use to make request
+    Return:
+        str: string conataining the sql request to send to postgres
+    """
+
+    # ---  Set queries ---
+    class_name = "CompanyContact"
+    try:
+        ipo = get_query_ranked_history(session, CompanyIpo, CompanyIpo.id_ipo)
+        contact = get_query_ranked_history(session, CompanyContact, CompanyContact.id_contact, 
+                                           CompanyContact.date_contact)
+        query = session.query(contact.c.id_company,
+                              ipo.c.id_ipo,
+                              ipo.c.date_ipo,
+                              contact.c.id_contact,
+                              contact.c.logo,
+                              contact.c.weburl,
+                              contact.c.phone,
+                              contact.c.date_contact,
+                              cast(null(), Integer).label("id_description"),
+                              cast(null(), String).label("name"),
+                              cast(null(), String).label("date_description"),
+                              literal("contact", String).label("alias"))\
+            .outerjoin(ipo, and_(ipo.c.id_company == contact.c.id_company, ipo.c.rank == 1))\
+            .filter(contact.c.rank > 1)\
+            .order_by(contact.c.id_company, contact.c.id_contact)
+        return query
+
+    except AttributeError:
+        print('An exception flew by!')
+        print('The attributes for the class {} are not good, or the query\
+code syntax has an error'.format(class_name))
+        sys.exit(1)
+
+
+def get_query_reserve_id_company(session, nb_ids):
+    """ Reserve new company ids from the PostgreSQL sequence company_id_company_seq, in one request.
+    The ids given by a sequence are never given again, so many loaders can run at the same time.
+    Args:
+        session (sqlalchemy.session): data base session, use to make request
+        nb_ids (int): number of ids to reserve
+    Return:
+        str: string conataining the sql request to send to postgres
+    """
+
+    # ---  Set queries ---
+    class_name = "Company"
+    try:
+        query = session.query(company_id_sequence.next_value().label("id_company"))\
+            .select_from(func.generate_series(1, nb_ids))
+        return query
+
+    except AttributeError:
+        print('An exception flew by!')
+        print('The attributes for the class {} are not good, or the query\
+code syntax has an error'.format(class_name))
+        sys.exit(1)
+
+
+def get_query_staging_new_names(session):
+    """ Get the staged rows whose name is not already in the database.
+    A null name is found like in a pandas merge, where null values are equal.
+    Args:
+        session (sqlalchemy.session): data base session, use to make request
+    Return:
+        str: string conataining the sql request to send to postgres
+    """
+
+    # ---  Set queries ---
+    class_name = "StagingProfile2"
+    try:
+        # Names of the companies, with a null name if a company has no description
+        name_exists = session.query(Company.id_company)\
+            .outerjoin(CompanyDescription, CompanyDescription.id_company == Company.id_company)\
+            .filter(CompanyDescription.name.isnot_distinct_from(StagingProfile2.name))\
+            .correlate(StagingProfile2)\
+            .exists()
+
+        query = session.query(StagingProfile2.name,
+                              StagingProfile2.logo,
+                              StagingProfile2.weburl,
+                              StagingProfile2.phone,
+                              StagingProfile2.ipo,
+                              StagingProfile2.date_description)\
+            .filter(~name_exists)\
+            .order_by(StagingProfile2.row_order)
+        return query
+
+    except AttributeError:
+        print('An exception flew by!')
+        print('The attributes for the class {} are not good, or the query\
+code syntax has an error'.format(class_name))
+        sys.exit(1)
+
+
+def get_query_staging_new_contacts(session):
+    """ Get the staged rows whose contact (phone, weburl, logo) is not already in the database.
+    Null values are found like in a pandas merge, where null values are equal.
+    Args:
+        session (sqlalchemy.session): data base session, use to make request
+    Return:
+        str: string conataining the sql request to send to postgres
+    """
+
+    # ---  Set queries ---
+    class_name = "StagingProfile2"
+    try:
+        # Contacts of the companies, with null values if a company has no contact
+        contact_exists = session.query(Company.id_company)\
+            .outerjoin(CompanyContact, CompanyContact.id_company == Company.id_company)\
+            .filter(and_(CompanyContact.phone.isnot_distinct_from(StagingProfile2.phone),
+                         CompanyContact.weburl.isnot_distinct_from(StagingProfile2.weburl),
+                         CompanyContact.logo.isnot_distinct_from(StagingProfile2.logo)))\
+            .correlate(StagingProfile2)\
+            .exists()
+
+        query = session.query(StagingProfile2.name,
+                              StagingProfile2.logo,
+                              StagingProfile2.weburl,
+                              StagingProfile2.phone,
+                              StagingProfile2.ipo,
+                              StagingProfile2.date_description)\
+            .filter(~contact_exists)\
+            .order_by(StagingProfile2.row_order)
+        return query
+
+    except AttributeError:
+        print('An exception flew by!')
+        print('The attributes for the class {} are not good, or the query\
+code syntax has an error'.format(class_name))
+        sys.exit(1)
+
+
+def get_query_staging_id_company(session):
+    """ Get the id of the companies with the same date Ipo than a staged row.
+    Only these companies can match a staged row, all the matches need the same date Ipo.
+    Args:
+        session (sqlalchemy.session): data base session, use to make request
+    Return:
+        str: string conataining the sql request to send to postgres
+    """
+
+    # ---  Set queries ---
+    class_name = "CompanyIpo"
+    try:
+        query = session.query(CompanyIpo.id_company)\
+            .filter(CompanyIpo.date_ipo.in_(session.query(StagingProfile2.ipo)))
+        return query
+
+    except AttributeError:
+        print('An exception flew by!')
+        print('The attributes for the class {} are not good, or the query\
+code syntax has an error'.format(class_name))
+        sys.exit(1)
+
+
+def get_query_max_id_company(session):
+    """ Get the highest company id of the company data table
+    Args:
+        session (sqlalchemy.session): data base session, use to make request
+    Return:
+        str: string conataining the sql request to send to postgres
+    """
+
+    # ---  Set queries ---
+    class_name = "Company"
+    try:
+        query = session.query(func.max(Company.id_company).label("max_id_company"))
+        return query
+
+    except AttributeError:
+        print('An exception flew by!')
+        print('The attributes for the class {} are not good, or the query\
+code syntax has an error'.format(class_name))
+        sys.exit(1)
@@ -0,0 +1,380 @@
+# pipeline imports
+import argparse
+import json
+import os
+import shutil
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from os import makedirs, replace
+from os.path import isdir, isfile, join
+
+from .lazy_imports import LazyModule
+from .manifest import get_files_to_ingest, load_manifest, save_manifest
+from .metrics import JsonLinesSink, PrometheusTextfileSink, add_metrics_sink
+
+__all__ = ["PIPELINE_STAGES", "STAGE_NAMES", "STATE_FILE_NAME", "load_state", "save_state", "save_checkpoint",
+           "load_checkpoint", "run_stage", "run_stage_in_thread", "run_pipeline"]
+
+# The stages import pandas, SQLAlchemy and the data base driver when they run, --help does not
+functions = LazyModule(".functions", __package__)
+connections = LazyModule(".connections", __package__)
+migrations = LazyModule(".migrations", __package__)
+
+
+# Stages of the pipeline, in the order they run, and the frames each one gives
+PIPELINE_STAGES = [("read_csv_files", ["df_company_profile2"]),
+                   ("read_data_base", ["df_merged_base"]),
+                   ("keep_new_names", ["df_company_new_name"]),
+                   ("check_status_new_name", ["df_comp_to_add", "df_comp_names_changed"]),
+                   ("keep_new_contacts", ["df_company_new_contact"]),
+                   ("check_status_new_contact", ["df_comp_contact_to_add", "df_comp_contact_changed"]),
+                   ("set_company_id", ["df_comp_to_add_with_id"]),
+                   ("format_data", ["df_company", "df_comp_description", "df_comp_contact", "df_comp_ipo"]),
+                   ("save_data", ["df_report"])]
+STAGE_NAMES = [stage for stage, lst_frames in PIPELINE_STAGES]
+STATE_FILE_NAME = "pipeline_state.json"
+
+
+def load_state(checkpoint_path):
+    """ Load the state of the last run: its files, the stages completed.
+    Args:
+        checkpoint_path (str): Location of the checkpoint folder
+    Returns:
+        dict: state of the run, empty if there is no run
+    """
+
+    state_path = join(checkpoint_path, STATE_FILE_NAME)
+    if not isfile(state_path):
+        return {}
+    with open(state_path) as file:
+        return json.load(file)
+
+
+def save_state(checkpoint_path, state):
+    """ Write the state of the run, in a temporary file first so a crash never leaves a truncated state.
+    Args:
+        checkpoint_path (str): Location of the checkpoint folder
+        state (dict): state of the run
+    """
+
+    state["updated_at"] = datetime.now().isoformat(timespec="seconds")
+    state_path = join(checkpoint_path, STATE_FILE_NAME)
+    with open(state_path + ".tmp", "w") as file:
+        json.dump(state, file, indent=1)
+    replace(state_path + ".tmp", state_path)
+
+
+def save_checkpoint(checkpoint_path, stage, dict_frames):
+    """ Write the frames given by a stage in Parquet files, in the folder of the stage.
+    Args:
+        checkpoint_path (str): Location of the checkpoint folder
+        stage (str): Stage name, like "read_data_base"
+        dict_frames (dict): For each frame name, the frame. A Series is saved as a one column table
+    """
+
+    import pandas as pd
+    stage_path = join(checkpoint_path, stage)
+    makedirs(stage_path, exist_ok=True)
+    for frame_name, df in dict_frames.items():
+        if isinstance(df, pd.Series):
+            df = df.to_frame()
+        # The frames built from empty ones have object columns of numbers, Parquet needs their type
+        df = df.infer_objects()
+        file_path = join(stage_path, "{}.parquet".format(frame_name))
+        df.to_parquet(file_path + ".tmp")
+        replace(file_path + ".tmp", file_path)
+
+
+def load_checkpoint(checkpoint_path, stage):
+    """ Read the frames given by a stage.
+    Args:
+        checkpoint_path (str): Location of the checkpoint folder
+        stage (str): Stage name, like "read_data_base"
+    Returns:
+        dict: For each frame name, the frame
+    """
+
+    import pandas as pd
+    lst_frames = dict(PIPELINE_STAGES)[stage]
+    dict_frames = {}
+    for frame_name in lst_frames:
+        file_path = join(checkpoint_path, stage, "{}.parquet".format(frame_name))
+        if not isfile(file_path):
+            print('An exception flew by!')
+            print("The checkpoint {} of the stage {} is missing - run the stage again".format(frame_name, stage))
+            sys.exit(1)
+        dict_frames[frame_name] = pd.read_parquet(file_path)
+    return dict_frames
+
+
+def run_stage(stage, dict_frames, state, session, engine, method="merge", snapshot_path=None, compact=False,
+              nb_processes=None, fuzzy_settings=None, upsert=False, nb_threads=None, streaming_settings=None):
+    """ Run one stage of the pipeline on the frames of the stages before.
+    Args:
+        stage (str): Stage name, like "read_data_base"
+        dict_frames (dict): Frames of the stages before, see PIPELINE_STAGES
+        state (dict): state of the run, with the folder "mypath" and the files "lst_files" to read. 
+            read_csv_files adds the records of the files read, "file_records"
+        session (sqlalchemy.session): data base session, use to make request
+        engine (sqlalchemy.engine): data base engine, used by session to know which data base is linked
+        method (str): method of read_data_base
+        snapshot_path (str): Location of the snapshot folder, for the method "snapshot"
+        compact (bool): Load the tables with compact types if True, see compact_frame
+        nb_processes (int): Number of processes resolving the rows by shards of dates Ipo, see resolve_company_ids
+        fuzzy_settings (dict): Settings of the fuzzy matching of the renames, see get_fuzzy_company_ids. 
+            Exact matching only if None
+        upsert (bool): Skip the rows already saved if True, see save_data
+        nb_threads (int): Number of threads downloading and saving the tables, see read_data_base 
+            and save_data. One table after the other if None
+        streaming_settings (dict): Settings of the streaming read of the files, see read_csv_files. 
+            All the files in memory if None
+    Returns:
+        dict: For each frame name given by the stage, the frame
+    """
+
+    if stage == "read_csv_files":
+        # The files are hashed when they are read, the manifest records them once saved
+        state["file_records"] = {}
+        df_company_profile2 = functions.read_csv_files(state["mypath"], lst_files=state["lst_files"],
+                                                       compact=compact, streaming_settings=streaming_settings,
+                                                       dict_file_records=state["file_records"])
+        return {"df_company_profile2": df_company_profile2}
+
+    if stage == "read_data_base":
+        df_merged_base = functions.read_data_base(session, method=method, snapshot_path=snapshot_path,
+                                                  compact=compact, nb_threads=nb_threads)
+        return {"df_merged_base": df_merged_base}
+
+    if stage == "keep_new_names":
+        df_company_new_name = functions.keep_new_names(dict_frames["df_company_profile2"],
+                                                       dict_frames["df_merged_base"])
+        return {"df_company_new_name": df_company_new_name}
+
+    if stage == "check_status_new_name":
+        df_comp_to_add, df_comp_names_changed = \
+            functions.check_status_new_name(dict_frames["df_company_new_name"], dict_frames["df_merged_base"],
+                                            nb_processes=nb_processes, fuzzy_settings=fuzzy_settings)
+        return {"df_comp_to_add": df_comp_to_add, "df_comp_names_changed": df_comp_names_changed}
+
+    if stage == "keep_new_contacts":
+        df_company_new_contact = functions.keep_new_contacts(dict_frames["df_company_profile2"],
+                                                             dict_frames["df_merged_base"])
+        return {"df_company_new_contact": df_company_new_contact}
+
+    if stage == "check_status_new_contact":
+        df_comp_contact_to_add, df_comp_contact_changed = \
+            functions.check_status_new_contact(dict_frames["df_company_new_contact"],
+                                               dict_frames["df_merged_base"], nb_processes=nb_processes)
+        return {"df_comp_contact_to_add": df_comp_contact_to_add,
+                "df_comp_contact_changed": df_comp_contact_changed}
+
+    if stage == "set_company_id":
+        df_comp_to_add_with_id = functions.set_company_id(dict_frames["df_comp_to_add"],
+                                                          dict_frames["df_merged_base"], session=session)
+        return {"df_comp_to_add_with_id": df_comp_to_add_with_id}
+
+    if stage == "format_data":
+        df_company, df_comp_description, df_comp_contact, df_comp_ipo = \
+            functions.format_data(dict_frames["df_comp_to_add_with_id"], dict_frames["df_comp_names_changed"],
+                                  dict_frames["df_comp_contact_changed"])
+        return {"df_company": df_company, "df_comp_description": df_comp_description,
+                "df_comp_contact": df_comp_contact, "df_comp_ipo": df_comp_ipo}
+
+    if stage == "save_data":
+        df_report = functions.save_data(dict_frames["df_company"], dict_frames["df_comp_description"],
+                                        dict_frames["df_comp_contact"], dict_frames["df_comp_ipo"], engine,
+                                        upsert=upsert, nb_threads=nb_threads)
+        return {"df_report": df_report}
+
+
+def run_stage_in_thread(stage, dict_frames, state, engine, **kwargs):
+    """ Run one stage of the pipeline with the session of the current thread, see run_stage.
+    Used to run a stage in another thread, the session of the main thread is not shared.
+    Args:
+        stage (str): Stage name, like "read_data_base"
+        dict_frames (dict): Frames of the stages before, see PIPELINE_STAGES
+        state (dict): state of the run, see run_stage
+        engine (sqlalchemy.engine): data base engine, used by session to know which data base is linked
+        kwargs: Settings of run_stage
+    Returns:
+        dict: For each frame name given by the stage, the frame
+    """
+
+    session_factory = connections.get_session_factory(engine)
+    try:
+        dict_stage_frames = run_stage(stage, dict_frames, state, session_factory(), engine, **kwargs)
+        session_factory().commit()
+        return dict_stage_frames
+    finally:
+        session_factory.remove()
+
+
+def run_pipeline(mypath, session, engine, checkpoint_path, resume_from=None, stop_after=None, full=False,
+                 method="merge", snapshot_path=None, compact=False, nb_processes=None, fuzzy_settings=None,
+                 upsert=False, nb_threads=None, streaming_settings=None):
+    """ Run the stages of the notebook post_data_from_finnhub, from the csv files to the database.
+    The frames given by each stage are saved in the checkpoint folder, so after a failure the
+    pipeline can resume from the failing stage without running the expensive ones again.
+    The files ingested are recorded in the manifest once saved.
+    Args:
+        mypath (str): Location of the files folder
+        session (sqlalchemy.session): data base session, use to make request
+        engine (sqlalchemy.engine): data base engine, used by session to know which data base is linked
+        checkpoint_path (str): Location of the checkpoint folder, created if needed
+        resume_from (str): Stage to start from, the stages before are read from their checkpoints.
+            From the first stage if None, the checkpoints of the last run are removed
+        stop_after (str): Last stage to run, all of them if None
+        full (bool): Read all the files if True, not only the new ones, see get_files_to_ingest
+        method (str): method of read_data_base
+        snapshot_path (str): Location of the snapshot folder, for the method "snapshot"
+        compact (bool): Load the tables with compact types if True, see compact_frame
+        nb_processes (int): Number of processes resolving the rows by shards of dates Ipo, see resolve_company_ids
+        fuzzy_settings (dict): Settings of the fuzzy matching of the renames, see get_fuzzy_company_ids. 
+            Exact matching only if None
+        upsert (bool): Skip the rows already saved if True, see save_data. A run resumed from 
+            save_data after a failure can not save a row twice, its tables are the ones of the 
+            checkpoint, with the same company ids
+        nb_threads (int): If given, the database is downloaded while the csv files are parsed, 
+            its tables at the same time, and the tables are saved at the same time after Company.
+            See read_data_base and save_data
+        streaming_settings (dict): Settings of the streaming read of the files, see read_csv_files. 
+            All the files in memory if None
+    Returns:
+        dict: For each frame name, the last frame given by the stages run or read
+    """
+
+    for stage in [resume_from, stop_after]:
+        if (stage is not None) and (stage not in STAGE_NAMES):
+            print('An exception flew by!')
+            print("The stage {} does not exist - choose one of {}".format(stage, ", ".join(STAGE_NAMES)))
+            sys.exit(1)
+
+    dict_frames = {}
+    if resume_from is None:
+        # New run, with the files to ingest now
+        if isdir(checkpoint_path):
+            shutil.rmtree(checkpoint_path)
+        makedirs(checkpoint_path)
+        manifest = load_manifest(mypath)
+        state = {"run_id": datetime.now().strftime("%Y%m%d_%H%M%S"), "mypath": mypath,
+                 "lst_files": get_files_to_ingest(mypath, manifest, full=full), "completed": []}
+        if manifest:
+            # Record the new mtime of the files only touched
+            save_manifest(mypath, manifest, {})
+        save_state(checkpoint_path, state)
+        start = 0
+    else:
+        # Same run, the stages before resume_from must be completed
+        state = load_state(checkpoint_path)
+        start = STAGE_NAMES.index(resume_from)
+        lst_missing = [stage for stage in STAGE_NAMES[:start] if stage not in state.get("completed", [])]
+        if lst_missing:
+            print('An exception flew by!')
+            print("The stages {} are not completed - resume from {}".format(", ".join(lst_missing), lst_missing[0]))
+            sys.exit(1)
+        for stage in STAGE_NAMES[:start]:
+            dict_frames.update(load_checkpoint(checkpoint_path, stage))
+
+    end = len(STAGE_NAMES) if stop_after is None else STAGE_NAMES.index(stop_after) + 1
+    if "set_company_id" in STAGE_NAMES[start:end]:
+        # The new company ids are reserved from the sequence on PostgreSQL
+        migrations.ensure_company_id_sequence(engine)
+    dict_settings = {"method": method, "snapshot_path": snapshot_path, "compact": compact, 
+                     "nb_processes": nb_processes, "fuzzy_settings": fuzzy_settings, "upsert": upsert,
+                     "nb_threads": nb_threads, "streaming_settings": streaming_settings}
+    future_base = None
+    for stage in STAGE_NAMES[start:end]:
+        print("Stage {}".format(stage))
+        if (nb_threads is not None) and (stage == "read_csv_files") and ("read_data_base" in STAGE_NAMES[start:end]) \
+                and connections.is_shared_between_threads(engine):
+            # The database is downloaded while the csv files are parsed
+            executor = ThreadPoolExecutor(max_workers=1)
+            future_base = executor.submit(run_stage_in_thread, "read_data_base", dict_frames, state, engine, 
+                                          **dict_settings)
+
+        if (stage == "read_data_base") and (future_base is not None):
+            dict_stage_frames = future_base.result()
+            executor.shutdown()
+        else:
+            dict_stage_frames = run_stage(stage, dict_frames, state, session, engine, **dict_settings)
+        save_checkpoint(checkpoint_path, stage, dict_stage_frames)
+        dict_frames.update(dict_stage_frames)
+        # Commit the reads of the stage, the next stages may save data
+        session.commit()
+
+        state["completed"] = [completed for completed in state["completed"] if completed != stage] + [stage]
+        save_state(checkpoint_path, state)
+
+        if stage == "save_data":
+            manifest = load_manifest(state["mypath"])
+            save_manifest(state["mypath"], manifest, state["file_records"], run_id=state["run_id"])
+
+    return dict_frames
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Post the finnhub profile2 files to the database.")
+    parser.add_argument("mypath", help="Location of the files folder")
+    parser.add_argument("--checkpoint-path", default="checkpoints", help="Location of the checkpoint folder")
+    parser.add_argument("--resume-from", choices=STAGE_NAMES, default=None,
+                        help="Stage to start from, the stages before are read from their checkpoints")
+    parser.add_argument("--stop-after", choices=STAGE_NAMES, default=None, help="Last stage to run")
+    parser.add_argument("--full", action="store_true", help="Read all the files, not only the new ones")
+    parser.add_argument("--method", choices=["merge", "join", "compare", "snapshot", "current"], default="merge",
+                        help="Method to load the database, see read_data_base")
+    parser.add_argument("--snapshot-path", default=None, help="Location of the snapshot, for the method snapshot")
+    parser.add_argument("--compact", action="store_true", help="Load the tables with compact types")
+    parser.add_argument("--processes", type=int, default=None,
+                        help="Number of processes resolving the companies by shards of dates Ipo")
+    parser.add_argument("--fuzzy", action="store_true", 
+                        help="Also find the renames with a similar phone or weburl, not only the same")
+    parser.add_argument("--fuzzy-threshold", type=float, default=None,
+                        help="Similarity (0 to 1) of the phone or the weburl for the fuzzy matching")
+    parser.add_argument("--stream", action="store_true", 
+                        help="Read the files by chunks, with only the names seen in memory")
+    parser.add_argument("--memory-budget", type=int, default=None,
+                        help="Megabytes of names kept in memory by --stream before they are spilled to disk")
+    parser.add_argument("--upsert", action="store_true", help="Skip the rows already saved in the database")
+    parser.add_argument("--threads", type=int, default=None,
+                        help="Number of threads downloading and saving the tables, while the csv files are parsed")
+    parser.add_argument("--db-url", default=None,
+                        help="Data base url, by default built from POSTGRES_USER, POSTGRES_PASSWORD, HOST, BD_NAME")
+    parser.add_argument("--metrics-json", default=None, help="File where to append the stage metrics as json lines")
+    parser.add_argument("--metrics-prom", default=None, help="Prometheus textfile where to write the stage metrics")
+    args = parser.parse_args()
+
+    if args.metrics_json is not None:
+        add_metrics_sink(JsonLinesSink(args.metrics_json))
+    if args.metrics_prom is not None:
+        add_metrics_sink(PrometheusTextfileSink(args.metrics_prom))
+
+    streaming_settings = None
+    if args.stream:
+        streaming_settings = {}
+        if args.memory_budget is not None:
+            streaming_settings = {"memory_budget": args.memory_budget * 1024 ** 2}
+    fuzzy_settings = None
+    if args.fuzzy:
+        fuzzy_settings = {}
+        if args.fuzzy_threshold is not None:
+            fuzzy_settings = {"phone": args.fuzzy_threshold, "weburl": args.fuzzy_threshold}
+
+    if args.db_url is not None:
+        engine = connections.get_engine(args.db_url)
+        session = connections.get_session_factory(engine)()
+    else:
+        # read global connection passwords from bash environment
+        session, engine = connections.data_base_connection(os.environ["POSTGRES_USER"],
+                                                           os.environ["POSTGRES_PASSWORD"], os.environ["HOST"],
+                                                           os.environ["BD_NAME"])
+
+    try:
+        run_pipeline(args.mypath, session, engine, args.checkpoint_path, resume_from=args.resume_from,
+                     stop_after=args.stop_after, full=args.full, method=args.method,
+                     snapshot_path=args.snapshot_path, compact=args.compact, nb_processes=args.processes,
+                     fuzzy_settings=fuzzy_settings, upsert=args.upsert, nb_threads=args.threads,
+                     streaming_settings=streaming_settings)
+    finally:
+        session.close()
+        connections.dispose_engines()
@@ -0,0 +1,202 @@
+# snapshot imports
+import hashlib
+import json
+import sys
+from datetime import datetime
+from os import makedirs, replace
+from os.path import isfile, join
+
+from .connections import get_pandas_from_query
+from .lazy_imports import LazyModule
+
+__all__ = ["WATERMARKS_FILE_NAME", "SNAPSHOT_SAFETY_WINDOW", "get_snapshot_tables", "read_snapshot_table",
+           "write_snapshot_table", "get_watermark", "refresh_snapshot", "get_table_checksum", "verify_snapshot"]
+
+# pandas and the models (so SQLAlchemy) are imported by the first function using them
+pd = LazyModule("pandas")
+model_requests = LazyModule(".model_requests", __package__)
+
+
+WATERMARKS_FILE_NAME = "watermarks.json"
+# Number of primary keys below the watermark fetched again at each refresh, for the rows committed
+# after rows with higher keys: the rows of the loads running during the refresh. The rows committed
+# later than that are found by verify_snapshot
+SNAPSHOT_SAFETY_WINDOW = 100
+
+
+def get_snapshot_tables():
+    """ Get the tables of the snapshot.
+    Returns:
+        list: For each table, its name, the function of its query and its primary key used as watermark
+    """
+
+    return [("company", model_requests.get_query_company, model_requests.Company.id_company),
+            ("companyipo", model_requests.get_query_company_ipo, model_requests.CompanyIpo.id_ipo),
+            ("companydescription", model_requests.get_query_company_description, 
+             model_requests.CompanyDescription.id_description),
+            ("companycontact", model_requests.get_query_company_contact, model_requests.CompanyContact.id_contact)]
+
+
+def read_snapshot_table(snapshot_path, table_name):
+    """ Read one table of the snapshot.
+    Args:
+        snapshot_path (str) : Location of the snapshot folder
+        table_name (str) : Table name, like "companyipo"
+    Returns:
+        pd.DataFrame: Table saved, None if the table is not in the snapshot
+    """
+
+    file_path = join(snapshot_path, "{}.parquet".format(table_name))
+    if not isfile(file_path):
+        return None
+    return pd.read_parquet(file_path)
+
+
+def write_snapshot_table(df_table, snapshot_path, table_name):
+    """ Write one table of the snapshot, in a temporary file first so a crash never leaves
+    a truncated table.
+    Args:
+        df_table (pd.DataFrame) : Table to save
+        snapshot_path (str) : Location of the snapshot folder
+        table_name (str) : Table name, like "companyipo"
+    """
+
+    file_path = join(snapshot_path, "{}.parquet".format(table_name))
+    df_table.to_parquet(file_path + ".tmp", index=False)
+    replace(file_path + ".tmp", file_path)
+
+
+def get_watermark(df_table, primary_key):
+    """ Get the high-water mark of a table of the snapshot, its highest primary key.
+    Args:
+        df_table (pd.DataFrame) : Table of the snapshot
+        primary_key (sqlalchemy.Column) : primary key of the table
+    Returns:
+        int: highest primary key, None if the table is empty
+    """
+
+    if (df_table is None) or df_table.empty:
+        return None
+    return int(df_table[primary_key.key].max())
+
+
+def refresh_snapshot(session, snapshot_path, safety_window=SNAPSHOT_SAFETY_WINDOW, verbose=True):
+    """ Bring the local snapshot of the tables Company, CompanyIpo, CompanyDescription and
+    CompanyContact up to date, fetching only the rows above the watermark of each table, minus
+    a safety window: the rows of the window are fetched again, so a row committed after rows
+    with higher keys is still found if its key is in the window.
+    The watermarks are the highest primary keys of the snapshot, they are also written
+    in watermarks.json. Below the window, rows inserted late, updated or deleted in the database
+    are not seen: use verify_snapshot to check it, and remove the folder to rebuild it.
+    Args:
+        session (sqlalchemy.session): data base session, use to make request
+        snapshot_path (str) : Location of the snapshot folder, created if needed
+        safety_window (int) : Number of primary keys below the watermark fetched again
+        verbose (bool): Print the number of rows fetched and new by table if True
+    Returns:
+        dict: For each table name, the table up to date
+    """
+
+    makedirs(snapshot_path, exist_ok=True)
+    dict_tables = {}
+    dict_watermarks = {}
+    for table_name, get_query, primary_key in get_snapshot_tables():
+        df_snapshot = read_snapshot_table(snapshot_path, table_name)
+        watermark = get_watermark(df_snapshot, primary_key)
+
+        # Fetch the rows above the start of the window, or the whole table the first time
+        query = get_query(session).order_by(primary_key)
+        if watermark is not None:
+            query = query.filter(primary_key > watermark - safety_window)
+        df_new = get_pandas_from_query(query, table_name, verbose=False)
+
+        if df_snapshot is None:
+            df_table = df_new
+            nb_new = len(df_new)
+            write_snapshot_table(df_table, snapshot_path, table_name)
+        else:
+            # The rows of the window are replaced by the ones fetched
+            df_kept = df_snapshot.loc[df_snapshot[primary_key.key] <= watermark - safety_window]
+            df_table = pd.concat([df_kept, df_new], ignore_index=True)
+            nb_new = len(df_table) - len(df_snapshot)
+            if not df_table.equals(df_snapshot):
+                write_snapshot_table(df_table, snapshot_path, table_name)
+            else:
+                df_table = df_snapshot
+        if verbose:
+            print("Rows fetched for {}: {}, new: {}".format(table_name, len(df_new), nb_new))
+
+        dict_tables[table_name] = df_table
+        dict_watermarks[table_name] = get_watermark(df_table, primary_key)
+
+    # Keep a record of the watermarks of the last refresh
+    dict_watermarks["refreshed_at"] = datetime.now().isoformat(timespec="seconds")
+    with open(join(snapshot_path, WATERMARKS_FILE_NAME), "w") as file:
+        json.dump(dict_watermarks, file, indent=1)
+
+    return dict_tables
+
+
+def get_table_checksum(df_table, primary_key):
+    """ Get the md5 of the rows of a table ordered by primary key, the same for a table of the
+    snapshot and one read from the database: the values are written as text, the empty ones as
+    "\\N" and the whole floats as integers (an integer column with empty values is read as float).
+    Args:
+        df_table (pd.DataFrame) : Table of the snapshot or of the database
+        primary_key (sqlalchemy.Column) : primary key of the table
+    Returns:
+        str: hexadecimal md5
+    """
+
+    def get_text(value):
+        if pd.isna(value):
+            return "\\N"
+        if isinstance(value, float) and value.is_integer():
+            return str(int(value))
+        return str(value)
+
+    df_table = df_table.sort_values(primary_key.key)
+    checksum = hashlib.md5()
+    for row in zip(*[df_table[column].map(get_text) for column in sorted(df_table.columns)]):
+        checksum.update("|".join(row).encode("utf-8") + b"\n")
+    return checksum.hexdigest()
+
+
+def verify_snapshot(session, snapshot_path, verbose=True):
+    """ Compare the snapshot with the database: number of rows and md5 of the rows of each table,
+    up to the watermark of the snapshot. The rows up to the watermark are read from the database,
+    run it from time to time rather than at each refresh.
+    Args:
+        session (sqlalchemy.session): data base session, use to make request
+        snapshot_path (str) : Location of the snapshot folder
+        verbose (bool): Print the comparison if True
+    Returns:
+        pd.DataFrame: For each table, rows and checksum of the snapshot and of the database
+    """
+
+    lst_report = []
+    for table_name, get_query, primary_key in get_snapshot_tables():
+        df_snapshot = read_snapshot_table(snapshot_path, table_name)
+        if df_snapshot is None:
+            print('An exception flew by!')
+            print("The table {} is not in the snapshot {} - refresh it first".format(table_name, snapshot_path))
+            sys.exit(1)
+
+        watermark = get_watermark(df_snapshot, primary_key)
+        df_data_base = df_snapshot.iloc[0:0]
+        if watermark is not None:
+            df_data_base = get_pandas_from_query(get_query(session).filter(primary_key <= watermark), table_name,
+                                                 verbose=False)
+
+        lst_report.append({"table": table_name,
+                           "rows_snapshot": len(df_snapshot),
+                           "rows_data_base": len(df_data_base),
+                           "checksum_snapshot": get_table_checksum(df_snapshot, primary_key),
+                           "checksum_data_base": get_table_checksum(df_data_base, primary_key)})
+
+    df_report = pd.DataFrame(lst_report)
+    df_report["is_same"] = (df_report["rows_snapshot"] == df_report["rows_data_base"]) & \
+                           (df_report["checksum_snapshot"] == df_report["checksum_data_base"])
+    if verbose:
+        print(df_report.to_string(index=False))
+    return df_report
@@ -0,0 +1,177 @@
+# streaming imports
+import shutil
+import tempfile
+from datetime import date
+from os.path import join
+
+from .formats import PROFILE2_READ_COLUMNS, get_file_columns, iter_profile2_table
+from .lazy_imports import LazyModule
+
+__all__ = ["STREAMING_SETTINGS", "is_in_sorted", "get_name_hashes", "SeenNames", "read_profile2_streaming"]
+
+# numpy and pandas are imported by the first function using them
+np = LazyModule("numpy")
+pd = LazyModule("pandas")
+
+
+# Default settings of the streaming read: the rows read at once from a file, the bytes of name
+# hashes kept in memory before they are spilled to disk, and the number of partitions on disk
+STREAMING_SETTINGS = {"chunksize": 100000, "memory_budget": 64 * 1024 ** 2, "nb_partitions": 16}
+
+
+def is_in_sorted(values, sorted_values):
+    """ Check which values are in a sorted array, by binary search.
+    Args:
+        values (np.array): values to look up
+        sorted_values (np.array): sorted values, without duplicates
+    Returns:
+        np.array: True for each value found
+    """
+
+    if len(sorted_values) == 0:
+        return np.zeros(len(values), dtype=bool)
+    positions = np.minimum(np.searchsorted(sorted_values, values), len(sorted_values) - 1)
+    return sorted_values[positions] == values
+
+
+def get_name_hashes(sr_name):
+    """ Hash the names on 64 bits. The empty names have the same hash, so only the first one is kept,
+    like drop_duplicates. Two different names have the same hash with a probability of about
+    n² / 2^65 for n names, 3e-8 for a million names.
+    Args:
+        sr_name (pd.Series): names
+    Returns:
+        np.array: hash of each name, uint64
+    """
+
+    return pd.util.hash_pandas_object(sr_name.astype(object), index=False).values
+
+
+class SeenNames:
+    """ Set of the hashes of the names already seen. The hashes are kept in memory, sorted, up to
+    memory_budget bytes, then spilled to disk in nb_partitions sorted files, by the first bits
+    of the hash. A lookup only loads the partitions of the hashes looked up, memory-mapped.
+    Args:
+        spill_path (str): Location of the partition files
+        memory_budget (int): bytes of hashes kept in memory, 8 by name
+        nb_partitions (int): Number of partition files
+    """
+
+    def __init__(self, spill_path, memory_budget=STREAMING_SETTINGS["memory_budget"],
+                 nb_partitions=STREAMING_SETTINGS["nb_partitions"]):
+        self.spill_path = spill_path
+        self.max_hashes = max(memory_budget // 8, 1)
+        self.nb_partitions = nb_partitions
+        self.memory = np.array([], dtype=np.uint64)
+        self.lst_spilled = []
+        self.nb_spills = 0
+
+    def get_partitions(self, hashes):
+        return (hashes >> np.uint64(56)).astype(np.int64) % self.nb_partitions
+
+    def get_partition_path(self, partition):
+        return join(self.spill_path, "seen_names_{}.npy".format(partition))
+
+    def contains(self, hashes):
+        """ Check which hashes were already added.
+        Args:
+            hashes (np.array): hashes of names, see get_name_hashes
+        Returns:
+            np.array: True for each hash already added
+        """
+
+        is_seen = is_in_sorted(hashes, self.memory)
+        if self.lst_spilled:
+            partitions = self.get_partitions(hashes)
+            for partition in np.unique(partitions[~is_seen]):
+                if partition not in self.lst_spilled:
+                    continue
+                is_partition = (partitions == partition) & ~is_seen
+                sorted_hashes = np.load(self.get_partition_path(partition), mmap_mode="r")
+                is_seen[is_partition] = is_in_sorted(hashes[is_partition], sorted_hashes)
+        return is_seen
+
+    def add(self, hashes):
+        """ Add hashes, and spill them all to disk if the memory budget is exceeded.
+        Args:
+            hashes (np.array): hashes of names, see get_name_hashes
+        """
+
+        self.memory = np.union1d(self.memory, hashes)
+        if len(self.memory) > self.max_hashes:
+            self.spill()
+
+    def spill(self):
+        """ Merge the hashes in memory into the partition files, then empty the memory """
+
+        partitions = self.get_partitions(self.memory)
+        for partition in np.unique(partitions):
+            hashes = self.memory[partitions == partition]
+            if partition in self.lst_spilled:
+                hashes = np.union1d(np.load(self.get_partition_path(partition)), hashes)
+            else:
+                self.lst_spilled.append(partition)
+            np.save(self.get_partition_path(partition), hashes)
+        self.memory = np.array([], dtype=np.uint64)
+        self.nb_spills += 1
+
+
+def read_profile2_streaming(lst_paths, chunksize=STREAMING_SETTINGS["chunksize"],
+                            memory_budget=STREAMING_SETTINGS["memory_budget"],
+                            nb_partitions=STREAMING_SETTINGS["nb_partitions"], spill_path=None, verbose=True):
+    """ Read the files got from finnhub by chunks, in the order of lst_paths, and keep each row
+    with a ticker and a name not seen before. Only the rows kept and the hashes of the names seen
+    (see SeenNames) are in memory, so the files can be bigger than the memory. Same result as
+    reading all the files then dropping the rows without ticker and the duplicate names,
+    keeping the first one.
+    Args:
+        lst_paths (list): Locations of the files, in the reading order
+        chunksize (int): Rows read at once from a file
+        memory_budget (int): bytes of name hashes kept in memory before they are spilled to disk
+        nb_partitions (int): Number of partition files on disk
+        spill_path (str): Folder of the temporary partitions, the system temporary folder by default
+        verbose (bool): Print the rows loaded and kept if True
+    Returns:
+        pd.DataFrame: Table with the columns name, logo, weburl, phone, ipo, date_description
+    """
+
+    columns = PROFILE2_READ_COLUMNS[1:]
+    # The date of the files, if none of them has it the date of today
+    lst_headers = [get_file_columns(path) for path in lst_paths]
+    has_date = any("date_description" in header for header in lst_headers)
+
+    nb_loaded, nb_with_ticker = 0, 0
+    lst_df = []
+    tmp_path = tempfile.mkdtemp(prefix="profile2_seen_names_", dir=spill_path)
+    try:
+        seen_names = SeenNames(tmp_path, memory_budget=memory_budget, nb_partitions=nb_partitions)
+        for path, header in zip(lst_paths, lst_headers):
+            usecols = [column for column in header if column in PROFILE2_READ_COLUMNS]
+            for df_chunk in iter_profile2_table(path, usecols, chunksize=chunksize):
+                nb_loaded += len(df_chunk)
+                df_chunk = df_chunk.dropna(subset=["ticker"])
+                nb_with_ticker += len(df_chunk)
+
+                # First row of each name in the chunk, if the name was not seen in the chunks before
+                hashes = get_name_hashes(df_chunk["name"])
+                is_new = ~pd.Series(hashes).duplicated().values
+                is_new[is_new] = ~seen_names.contains(hashes[is_new])
+                seen_names.add(hashes[is_new])
+                lst_df.append(df_chunk.loc[is_new].reindex(columns=columns))
+    finally:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+    if lst_df:
+        df_company_profile2 = pd.concat(lst_df, ignore_index=True)
+    else:
+        df_company_profile2 = pd.DataFrame(columns=columns)
+    if not has_date:
+        df_company_profile2["date_description"] = date.today()
+
+    if verbose:
+        print("Number of rows loaded: ", nb_loaded)
+        print("Number of rows kept after ticker dropna: ", nb_with_ticker)
+        print("Number of rows kept after drop comp name duplicates: ", len(df_company_profile2))
+        if seen_names.nb_spills:
+            print("Names spilled to disk: {} times".format(seen_names.nb_spills))
+    return df_company_profile2
@@ -0,0 +1,216 @@
+# synthetic_data imports
+import argparse
+import os
+from os.path import join
+import numpy as np
+import pandas as pd
+
+from .connections import get_engine
+from .functions import save_data
+from .manifest import get_profile2_columns, get_profile2_file_name
+from .migrations import ensure_company_id_sequence
+from .model_requests import Base, Company, CompanyContact, CompanyDescription, CompanyIpo
+
+__all__ = ["generate_universe", "generate_data_base", "generate_profile2", "write_profile2_files", "create_data_base",
+           "generate_data_set"]
+
+
+def generate_universe(nb_companies, seed=0, ratio_none=0.03):
+    """ Draw the attributes of each company which do not change: name, contact and IPO date.
+    Some companies have no phone and no weburl.
+    Args:
+        nb_companies (int): Number of companies of the universe
+        seed (int): Seed of the random generator, the same seed gives the same data
+        ratio_none (float): Ratio of the companies with None phone and weburl
+    Returns:
+        pd.DataFrame: Table with the columns name, logo, phone, weburl, ipo, id_company
+    """
+
+    generator = np.random.default_rng(seed)
+    sr_id = pd.Series(np.arange(1, nb_companies + 1))
+    sr_id_str = sr_id.astype(str)
+
+    # About 20 companies by IPO date
+    nb_dates = max(nb_companies // 20, 10)
+    dates = pd.date_range("1980-01-01", periods=nb_dates, freq="D").strftime("%Y-%m-%d").values
+
+    df_universe = pd.DataFrame({"name": "COMP " + sr_id_str,
+                                "logo": "https://static.finnhub.io/logo/comp_" + sr_id_str + ".png",
+                                "ipo": generator.choice(dates, nb_companies),
+                                "id_company": sr_id})
+    is_none = generator.random(nb_companies) < ratio_none
+
+    # Phones and weburls as different as the real ones
+    df_universe["phone"] = generator.integers(2000000000, 9999999999, nb_companies).astype(str)
+    letters = np.array(list("abcdefghijklmnopqrstuvwxyz"))
+    sr_domain = pd.Series(["".join(word) for word in generator.choice(letters, (nb_companies, 8))])
+    df_universe["weburl"] = "https://" + sr_domain + sr_id_str + ".com/"
+    df_universe = df_universe[["name", "logo", "phone", "weburl", "ipo", "id_company"]]
+    df_universe.loc[is_none, ["phone", "weburl"]] = None
+    return df_universe
+
+
+def generate_data_base(df_universe, seed=0, ratio_in_base=0.9, ratio_history=0.1):
+    """ Generate the tables of a database with the first companies of the universe already loaded.
+    Some companies have an older name and an older contact (history).
+    Args:
+        df_universe (pd.DataFrame): Companies, from generate_universe
+        seed (int): Seed of the random generator, the same seed gives the same data
+        ratio_in_base (float): Ratio of the companies already in the database
+        ratio_history (float): Ratio of the companies with an older name and an older contact
+    Returns:
+        pd.DataFrame: Table Company
+        pd.DataFrame: Table CompanyIpo
+        pd.DataFrame: Table CompanyDescription
+        pd.DataFrame: Table CompanyContact
+    """
+
+    generator = np.random.default_rng(seed + 1)
+    df_base = df_universe.iloc[:int(len(df_universe) * ratio_in_base)]
+    is_history = generator.random(len(df_base)) < ratio_history
+
+    df_company = df_base[["id_company"]].copy()
+    df_comp_ipo = df_base[["ipo", "id_company"]].rename(columns={"ipo": "date_ipo"})
+
+    # Names and contacts, the history rows come first, like older records
+    df_old = df_base.loc[is_history].copy()
+    df_old["name"] = df_old["name"] + " OLD"
+    df_old["phone"] = "00" + df_old["phone"].fillna("")
+    df_history = pd.concat([df_old, df_base], ignore_index=True)
+    df_history["date_description"] = None
+
+    df_comp_description = df_history[["date_description", "name", "id_company"]]
+    df_comp_contact = df_history[["date_description", "logo", "phone", "weburl", "id_company"]]\
+        .rename(columns={"date_description": "date_contact"})
+
+    return df_company, df_comp_ipo, df_comp_description, df_comp_contact
+
+
+def generate_profile2(df_universe, seed=0, ratio_in_base=0.9, ratio_renamed=0.05, ratio_contact_changed=0.05,
+                      ratio_duplicates=0.01, ratio_no_ticker=0.01, ratio_reformatted=0.0):
+    """ Generate the profile2 data got from finnhub for the whole universe: renamed companies, 
+    companies with a new phone or weburl, new companies (the ones not in the database), 
+    duplicate names, rows without ticker, renamed companies with their phone and weburl reformatted.
+    Args:
+        df_universe (pd.DataFrame): Companies, from generate_universe
+        seed (int): Seed of the random generator, the same seed gives the same data
+        ratio_in_base (float): Ratio of the companies already in the database, see generate_data_base
+        ratio_renamed (float): Ratio of the companies with a new name
+        ratio_contact_changed (float): Ratio of the companies with a new phone or weburl
+        ratio_duplicates (float): Ratio of rows repeated with the same name
+        ratio_no_ticker (float): Ratio of rows without ticker
+        ratio_reformatted (float): Ratio of the renamed companies with their phone written 
+            "+1 123-456-7890" and their weburl "http://www.abcd-efgh1.com", they do not match exactly
+    Returns:
+        pd.DataFrame: Table with the profile2 columns, in random order
+    """
+
+    generator = np.random.default_rng(seed + 2)
+    nb_companies = len(df_universe)
+    df_profile2 = df_universe.drop(columns="id_company")
+    sr_id_str = df_universe["id_company"].astype(str)
+    df_profile2["ticker"] = "T" + sr_id_str
+
+    # Changes of the companies in the database
+    is_in_base = np.arange(nb_companies) < int(nb_companies * ratio_in_base)
+    is_renamed = is_in_base & (generator.random(nb_companies) < ratio_renamed)
+    df_profile2.loc[is_renamed, "name"] = df_profile2.loc[is_renamed, "name"] + " NEW"
+    is_changed = is_in_base & ~is_renamed & (generator.random(nb_companies) < ratio_contact_changed)
+    is_phone = generator.random(nb_companies) < 0.5
+    df_profile2.loc[is_changed & is_phone, "phone"] = "1" + df_profile2.loc[is_changed & is_phone, "phone"]
+    df_profile2.loc[is_changed & ~is_phone, "weburl"] = "https://new" + sr_id_str[is_changed & ~is_phone] + ".com/"
+
+    # Duplicate names and rows without ticker
+    df_duplicates = df_profile2.loc[generator.random(nb_companies) < ratio_duplicates].copy()
+    df_duplicates["phone"] = "9" + df_duplicates["phone"].fillna("")
+    df_profile2 = pd.concat([df_profile2, df_duplicates], ignore_index=True)
+    df_profile2.loc[generator.random(len(df_profile2)) < ratio_no_ticker, "ticker"] = None
+
+    # Other finnhub columns
+    df_profile2["country"] = "US"
+    df_profile2["currency"] = "USD"
+    df_profile2["exchange"] = "NASDAQ NMS - GLOBAL MARKET"
+    df_profile2["finnhubIndustry"] = generator.choice(["Banking", "Biotechnology", "Media", "Retail"],
+                                                      len(df_profile2))
+    df_profile2["marketCapitalization"] = generator.random(len(df_profile2)) * 1000
+    df_profile2["shareOutstanding"] = generator.random(len(df_profile2)) * 100
+
+    # Renames with the phone and the weburl reformatted, drawn last to keep the other draws
+    is_reformatted = is_renamed & (generator.random(nb_companies) < ratio_reformatted)
+    is_reformatted = np.append(is_reformatted, np.zeros(len(df_profile2) - nb_companies, dtype=bool))
+    sr_phone = df_profile2.loc[is_reformatted, "phone"]
+    df_profile2.loc[is_reformatted, "phone"] = "+1 " + sr_phone.str[:3] + "-" + sr_phone.str[3:6] + "-" + \
+                                               sr_phone.str[6:]
+    sr_weburl = df_profile2.loc[is_reformatted, "weburl"]
+    df_profile2.loc[is_reformatted, "weburl"] = "http://www." + sr_weburl.str[8:12] + "-" + \
+                                                sr_weburl.str[12:].str.rstrip("/")
+
+    df_profile2 = df_profile2.sample(frac=1, random_state=seed).reset_index(drop=True)
+    return df_profile2[get_profile2_columns()]
+
+
+def write_profile2_files(df_profile2, mypath, file_size=500):
+    """ Write the profile2 data in files named like the finnhub ones, "company_profile2_0_499.csv"...
+    Args:
+        df_profile2 (pd.DataFrame): Table with the profile2 columns
+        mypath (str): Location of the files folder, created if needed
+        file_size (int): Number of rows by file
+    Returns:
+        list: file names written
+    """
+
+    os.makedirs(mypath, exist_ok=True)
+    lst_files = []
+    for start in range(0, len(df_profile2), file_size):
+        end = min(start + file_size, len(df_profile2)) - 1
+        file = get_profile2_file_name(start, end)
+        df_profile2.iloc[start:end + 1].to_csv(join(mypath, file), index=False)
+        lst_files.append(file)
+    return lst_files
+
+
+def create_data_base(engine, df_company, df_comp_ipo, df_comp_description, df_comp_contact):
+    """ Create the 4 tables in an empty database, removing them first, and load the data.
+    On PostgreSQL, the company id sequence is then moved after the ids loaded, so the loads 
+    reserving ids from it do not give them again. Use only a throwaway database.
+    Args:
+        engine (sqlalchemy.engine): data base engine, used by session to know which data base is linked
+        df_company (pd.DataFrame): Table Company
+        df_comp_ipo (pd.DataFrame): Table CompanyIpo
+        df_comp_description (pd.DataFrame): Table CompanyDescription
+        df_comp_contact (pd.DataFrame): Table CompanyContact
+    """
+
+    tables = [Company.__table__, CompanyIpo.__table__, CompanyDescription.__table__, CompanyContact.__table__]
+    Base.metadata.drop_all(engine, tables=tables)
+    Base.metadata.create_all(engine, tables=tables)
+    save_data(df_company, df_comp_description, df_comp_contact, df_comp_ipo, engine, verbose=False)
+    ensure_company_id_sequence(engine, verbose=False)
+
+
+def generate_data_set(nb_companies, mypath, engine, seed=0):
+    """ Generate a universe of companies: the profile2 files in mypath and the database state.
+    Args:
+        nb_companies (int): Number of companies of the universe
+        mypath (str): Location of the files folder, created if needed
+        engine (sqlalchemy.engine): engine of a throwaway database, its tables are replaced
+        seed (int): Seed of the random generator, the same seed gives the same data
+    Returns:
+        list: profile2 file names written
+    """
+
+    df_universe = generate_universe(nb_companies, seed=seed)
+    create_data_base(engine, *generate_data_base(df_universe, seed=seed))
+    return write_profile2_files(generate_profile2(df_universe, seed=seed), mypath)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate profile2 files and a database state.")
+    parser.add_argument("nb_companies", type=int, help="Number of companies of the universe")
+    parser.add_argument("mypath", help="Location of the files folder")
+    parser.add_argument("--db-url", default="sqlite:///synthetic.db", help="Throwaway database, its tables are replaced")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the random generator")
+    args = parser.parse_args()
+
+    lst_files = generate_data_set(args.nb_companies, args.mypath, get_engine(args.db_url), seed=args.seed)
+    print("Files written: {}".format(len(lst_files)))